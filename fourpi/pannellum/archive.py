@@ -0,0 +1,255 @@
+#!/usr/bin/env  python
+# -*- coding: utf-8 -*-
+"""Keep the tiles of a scene in a single file and serve them from there.
+
+The archive is a SQLite database of the tiles, named by their path in the
+tile folder, e.g. ``3/f0_1.jpg`` or ``fallback/f.jpg``. The encoded tiles
+are stored once per content.
+"""
+
+import argparse
+import functools
+import hashlib
+import http.server
+import logging
+import os
+import sqlite3
+import threading
+import urllib.parse
+
+from fourpi.pannellum.metrics import metrics
+from fourpi.pannellum.utils import _expand, _get_or_create_path
+
+ARCHIVE = 'tiles.sqlite'
+# encoded tiles held before they are written in one transaction
+PENDING_BYTES = 32 * 2 ** 20
+CONTENT_TYPES = {
+    'jpg': 'image/jpeg',
+    'png': 'image/png',
+    'webp': 'image/webp',
+}
+
+logger = logging.getLogger('pannellum.archive')
+
+
+class TileArchive:
+    """The tiles of a scene in a SQLite file.
+
+    Tiles put are held until ``sync``, ``close`` or ``PENDING_BYTES`` of
+    them, and written in one short transaction, as other processes may be
+    waiting to write theirs.
+    """
+
+    def __init__(self, path, readonly=False):
+
+        self.path = _expand(path)
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._pending_bytes = 0
+        if readonly:
+            self.db = sqlite3.connect('file:%s?mode=ro' % self.path, uri=True, check_same_thread=False)
+            return
+        _get_or_create_path(os.path.dirname(self.path))
+        # several processes may write the faces of a scene
+        self.db = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        # a crash may lose the last transactions, not corrupt the archive
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS blobs (
+                               digest TEXT PRIMARY KEY,
+                               data BLOB)""")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS tiles (
+                               name TEXT PRIMARY KEY,
+                               digest TEXT)""")
+        self.db.commit()
+
+    def put(self, name, data):
+        digest = hashlib.sha1(data).hexdigest()
+        with self._lock:
+            self._pending[name] = (data, digest)
+            self._pending_bytes += len(data)
+            if self._pending_bytes >= PENDING_BYTES:
+                self._flush()
+
+    def _flush(self):
+        if not self._pending:
+            return
+        written = 0
+        with self.db:
+            for data, digest in self._pending.values():
+                # only a new content takes space
+                if self.db.execute("INSERT OR IGNORE INTO blobs (digest, data) VALUES (?, ?)",
+                                   (digest, data)).rowcount:
+                    written += len(data)
+            self.db.executemany("INSERT OR REPLACE INTO tiles (name, digest) VALUES (?, ?)",
+                                [(name, digest) for name, (data, digest) in self._pending.items()])
+        self._pending = {}
+        self._pending_bytes = 0
+        metrics.count('bytes_written', written)
+
+    def sync(self):
+        """write the tiles put so far"""
+
+        with self._lock:
+            self._flush()
+
+    def get(self, name):
+        """return the data and digest of a tile, None if missing"""
+
+        with self._lock:
+            if name in self._pending:
+                return self._pending[name]
+            return self.db.execute("""SELECT data, tiles.digest FROM tiles JOIN blobs
+                                      ON tiles.digest = blobs.digest WHERE name = ?""", (name,)).fetchone()
+
+    def __contains__(self, name):
+        with self._lock:
+            if name in self._pending:
+                return True
+            return self.db.execute("SELECT 1 FROM tiles WHERE name = ?", (name,)).fetchone() is not None
+
+    def names(self):
+        with self._lock:
+            self._flush()
+            return [row[0] for row in self.db.execute("SELECT name FROM tiles ORDER BY name")]
+
+    def clear(self):
+        with self._lock:
+            self._pending = {}
+            self._pending_bytes = 0
+            self.db.execute("DELETE FROM tiles")
+            self.db.execute("DELETE FROM blobs")
+            self.db.commit()
+
+    def close(self):
+        self.sync()
+        self.db.close()
+
+
+class ArchiveWriter:
+    """Saves images with an encoder into the archive of a tile folder.
+
+    Used in place of the encoder. The archive is opened on first use, also
+    by every worker process a copy is sent to.
+    """
+
+    # no tile is a file of its own, nor are there folders for them
+    writes_files = False
+
+    def __init__(self, encoder, folder):
+
+        self.encoder = encoder
+        self.folder = folder
+        self.extension = encoder.extension
+        self._archive = None
+
+    def __getstate__(self):
+        return {'encoder': self.encoder, 'folder': self.folder, 'extension': self.extension, '_archive': None}
+
+    @property
+    def archive(self):
+        if self._archive is None:
+            self._archive = TileArchive(os.path.join(self.folder, ARCHIVE))
+        return self._archive
+
+    def _name(self, filename):
+        return os.path.relpath(filename, self.folder).replace(os.sep, '/')
+
+    def save(self, image, filename):
+        self.archive.put(self._name(filename), self.encoder.encode(image))
+
+    def exists(self, filename):
+        return self._name(filename) in self.archive
+
+    def sync(self):
+        if self._archive is not None:
+            self._archive.sync()
+
+    def close(self):
+        if self._archive is not None:
+            self._archive.close()
+            self._archive = None
+
+
+class ArchiveHandler(http.server.SimpleHTTPRequestHandler):
+    """Serves tiles from the archives below the directory, other files as they are.
+
+    ``/<scene>/<level>/<face><y>_<x>.<ext>`` is answered from the archive in
+    the folder of the scene, or ``/<level>/<face><y>_<x>.<ext>`` if the
+    directory is the tile folder of a single scene.
+    """
+
+    def _find(self):
+        path = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path)
+        parts = [part for part in path.split('/') if part]
+        if '..' in parts:
+            return None, None
+        for scene in (0, 1):
+            archive = os.path.join(self.directory, *parts[:scene], ARCHIVE)
+            if len(parts) > scene and os.path.isfile(archive):
+                return archive, '/'.join(parts[scene:])
+        return None, None
+
+    def _send_tile(self, head=False):
+        archive, name = self._find()
+        tile = None
+        if archive:
+            tiles = TileArchive(archive, readonly=True)
+            try:
+                tile = tiles.get(name)
+            finally:
+                tiles.close()
+        if tile is None:
+            return False
+        data, digest = tile
+        etag = '"%s"' % digest
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return True
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPES.get(name.rsplit('.', 1)[-1], 'application/octet-stream'))
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        if not head:
+            self.wfile.write(data)
+        return True
+
+    def do_GET(self):
+        if not self._send_tile():
+            super().do_GET()
+
+    def do_HEAD(self):
+        if not self._send_tile(head=True):
+            super().do_HEAD()
+
+
+def server(folder, port=8000, bind='127.0.0.1'):
+    """return a threading HTTP server for the tile archives below folder"""
+
+    handler = functools.partial(ArchiveHandler, directory=_expand(folder))
+    return http.server.ThreadingHTTPServer((bind, port), handler)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Serve pannellum tiles from their archives')
+    parser.add_argument('folder', nargs='?', default='.', help='Tile folder. Default: the current directory')
+    parser.add_argument('-p', '--port', type=int, default=8000, help='Port. Default: 8000')
+    parser.add_argument('-b', '--bind', default='127.0.0.1', help='Address to listen on. Default: 127.0.0.1')
+    args = parser.parse_args()
+
+    httpd = server(args.folder, args.port, args.bind)
+    print("Serving %s on http://%s:%s/" % (args.folder, args.bind, httpd.server_address[1]))
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+
+
+if __name__ == "__main__":
+    main()
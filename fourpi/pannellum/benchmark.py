@@ -0,0 +1,305 @@
+#!/usr/bin/env  python
+# -*- coding: utf-8 -*-
+"""Time the stages of the pipeline on synthetic panoramas.
+
+The results are written as JSON, so runs of different commits can be
+compared; stages slower than a baseline by more than a threshold are
+reported as regressions. Stages needing nona or exiftool are skipped if
+those are not installed. The startup of the console scripts, importing their
+module in a new interpreter, is held against a budget of its own.
+"""
+
+import argparse
+import json
+import logging
+import math
+import os
+import platform
+import random
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+import PIL
+import PIL.Image
+
+from fourpi.pannellum import hotspot, jpeg, remap, scene, utils
+from fourpi.pannellum.exif import Exif
+from fourpi.pannellum.scene import Scene
+from fourpi.pannellum.spatial import neighbours
+from fourpi.pannellum.tour import Tour
+
+# name: (width, height, full panorama height if cropped)
+PANORAMAS = {
+    'small': (2000, 1000, None),
+    'medium': (4000, 2000, None),
+    'large': (8000, 4000, None),
+    'cropped': (4000, 1000, 2000),
+}
+DEFAULT_PANORAMAS = ('small', 'medium', 'cropped')
+# scenes of the synthetic tour for the hotspot and json stages
+TOUR_SCENES = 200
+REPEAT = 3
+THRESHOLD = 0.2
+# modules of the console scripts, imported on every call
+ENTRY_POINTS = {
+    'pannellum': 'fourpi.pannellum.tour',
+    'exif2rst': 'fourpi.pannellum.exif',
+    'eq2cyl': 'fourpi.pannellum.eq2cyl',
+}
+# seconds to start python and import one of them
+STARTUP_BUDGET = 0.3
+# GPano metadata of cropped panoramas, as written by stitchers
+GPANO_XMP = (
+    '<x:xmpmeta xmlns:x="adobe:ns:meta/">'
+    '<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">'
+    '<rdf:Description rdf:about="" xmlns:GPano="http://ns.google.com/photos/1.0/panorama/"'
+    ' GPano:ProjectionType="equirectangular"'
+    ' GPano:FullPanoWidthPixels="%(width)s" GPano:FullPanoHeightPixels="%(pano_height)s"'
+    ' GPano:CroppedAreaImageWidthPixels="%(width)s" GPano:CroppedAreaImageHeightPixels="%(height)s"'
+    ' GPano:CroppedAreaLeftPixels="0" GPano:CroppedAreaTopPixels="%(top)s"/>'
+    '</rdf:RDF></x:xmpmeta>')
+
+logger = logging.getLogger('pannellum.benchmark')
+
+
+def synthetic_panorama(path, width, height, pano_height=None):
+    """Write a panorama with some detail, so the tiles do not compress to nothing.
+
+    A cropped panorama, part of one pano_height high, gets its GPano XMP.
+    """
+
+    detail = PIL.Image.effect_mandelbrot((width // 4, height // 4), (-2.2, -1.2, 1.0, 1.2), 64)
+    noise = PIL.Image.effect_noise((width, height), 32)
+    image = PIL.Image.merge('RGB', (detail.resize((width, height)), noise, PIL.Image.linear_gradient('L').resize((width, height))))
+    image.save(path, quality=90)
+    if pano_height:
+        xmp = jpeg.XMP_HEADER + (GPANO_XMP % {'width': width, 'height': height, 'pano_height': pano_height,
+                                              'top': (pano_height - height) // 2}).encode('utf-8')
+        with open(path, 'rb') as f:
+            data = f.read()
+        # an APP1 segment right after the start of image
+        with open(path, 'wb') as f:
+            f.write(data[:2] + struct.pack('>BBH', 0xFF, 0xE1, len(xmp) + 2) + xmp + data[2:])
+    return path
+
+
+def synthetic_exifdata(name, width, height, pano_height=None):
+    """exifdata as read by Exif, including the GPano tags of cropped panoramas"""
+
+    values = {'title': name, 'width': width, 'height': height}
+    if pano_height:
+        values.update({'panoHeight': pano_height, 'croppedHeight': height,
+                       'croppedTop': (pano_height - height) // 2})
+    return values
+
+
+def synthetic_tour(scenes=TOUR_SCENES, seed=1):
+    """exifdata of a tour with scenes spread over a few kilometers"""
+
+    rng = random.Random(seed)
+    exifdata = {}
+    for i in range(scenes):
+        exifdata['scene%04d' % i] = {'title': 'Scene %s' % i, 'width': 4000, 'height': 2000,
+                                     'latlng': (51.2 + rng.uniform(0, 0.03), 6.7 + rng.uniform(0, 0.05)),
+                                     'northOffset': rng.uniform(0, 360)}
+    return exifdata
+
+
+def _git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(__file__),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Benchmark:
+    """Times every stage ``repeat`` times, keeping the fastest run."""
+
+    def __init__(self, folder, **kwargs):
+
+        self.folder = folder
+        self.repeat = kwargs.get('repeat', REPEAT)
+        self.panoramas = kwargs.get('panoramas', DEFAULT_PANORAMAS)
+        self.tour_scenes = kwargs.get('tour_scenes', TOUR_SCENES)
+        self.results = {}
+        self.skipped = {}
+
+    def _time(self, name, stage, prepare=None):
+        runs = []
+        for i in range(self.repeat):
+            if prepare:
+                prepare()
+            start = time.perf_counter()
+            stage()
+            runs.append(time.perf_counter() - start)
+        self.results[name] = {'seconds': min(runs), 'runs': runs}
+        logger.info("%s: %.3fs", name, min(runs))
+
+    def _skip(self, name, reason):
+        self.skipped[name] = reason
+        logger.info("%s skipped: %s", name, reason)
+
+    def run_panorama(self, name):
+        width, height, pano_height = PANORAMAS[name]
+        path = synthetic_panorama(os.path.join(self.folder, '%s.jpg' % name), width, height, pano_height)
+        exifdata = {name: synthetic_exifdata(name, width, height, pano_height)}
+
+        self._time('%s/exif' % name, lambda: Exif([path], backend='python').get_exifdata())
+        if utils.find_tool('exiftool'):
+            self._time('%s/exif-exiftool' % name, lambda: Exif([path], backend='exiftool').get_exifdata())
+        else:
+            self._skip('%s/exif-exiftool' % name, 'exiftool not found')
+
+        remappers = [r for r, available in (('nona', utils.find_tool('nona')), ('numpy', remap.numpy)) if available]
+        if not remappers:
+            self._skip('%s/extract' % name, 'neither nona nor numpy found')
+            return
+        for remapper in scene.REMAPPERS:
+            if remapper not in remappers:
+                self._skip('%s/extract-%s' % (name, remapper), '%s not found' % remapper)
+                continue
+            s = Scene(path, exifdata=exifdata, remapper=remapper, tile_folder=os.path.join(self.folder, remapper),
+                      keep_faces=True)
+            self._time('%s/extract-%s' % (name, remapper), s.extract)
+
+        s = Scene(path, exifdata=exifdata, remapper=remappers[0], tile_folder=os.path.join(self.folder, 'tiles'),
+                  keep_faces=True)
+        s.tile(force=True)
+
+        def untiled():
+            # keep the extracted faces, tile them again
+            manifest = s.read_manifest()
+            manifest['faces'] = []
+            s._write_manifest(manifest)
+
+        def unscaled():
+            s.fallbacks = []
+
+        self._time('%s/tile' % name, s.tile, untiled)
+        self._time('%s/fallback' % name, lambda: s.fallback(force=True), unscaled)
+
+        # extracting and tiling without writing the faces
+        built = Scene(path, exifdata=exifdata, remapper=remappers[0], tile_folder=os.path.join(self.folder, 'memory'))
+        self._time('%s/build' % name, lambda: built.tile(force=True))
+
+    def run_tour(self):
+        exifdata = synthetic_tour(self.tour_scenes)
+        panoramas = ['%s.jpg' % scene_id for scene_id in exifdata]
+
+        def hotspots():
+            if utils.numpy:
+                return hotspot.get_confs(exifdata, dict(
+                    (scene_id, neighbours(scene_id, exifdata)) for scene_id in exifdata))
+            return [hotspot.HotSpot(dest, exifdata[src], exifdata[dest]).get_conf()
+                    for src in exifdata for dest in neighbours(src, exifdata)]
+
+        self._time('tour/hotspots', hotspots)
+        self._time('tour/scenes', lambda: Tour(exifdata, panoramas))
+        tour = Tour(exifdata, panoramas)
+        self._time('tour/json', tour.get_json)
+
+    def run_startup(self):
+        for name, module in sorted(ENTRY_POINTS.items()):
+            command = [sys.executable, '-c', 'import %s' % module]
+            self._time('startup/%s' % name, lambda command=command: subprocess.run(command, check=True))
+
+    def run(self):
+        self.run_startup()
+        for name in self.panoramas:
+            self.run_panorama(name)
+        self.run_tour()
+        return self.report()
+
+    def report(self):
+        return {
+            'meta': {
+                'revision': _git_revision(),
+                'date': time.strftime("%Y-%m-%dT%H:%M:%S"),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'pillow': PIL.__version__,
+                'numpy': utils.numpy.__version__ if utils.numpy else None,
+                'nona': utils.find_tool('nona'),
+                'exiftool': utils.find_tool('exiftool'),
+                'repeat': self.repeat,
+            },
+            'results': self.results,
+            'skipped': self.skipped,
+        }
+
+
+def regressions(report, baseline, threshold=THRESHOLD):
+    """Return (stage, seconds, baseline seconds) of stages slower by more than threshold"""
+
+    slower = []
+    for name, result in sorted(report['results'].items()):
+        before = baseline.get('results', {}).get(name)
+        if before and result['seconds'] > before['seconds'] * (1 + threshold):
+            slower.append((name, result['seconds'], before['seconds']))
+    return slower
+
+
+def over_budget(report, budget=STARTUP_BUDGET):
+    """Return (stage, seconds) of the startup stages taking longer than budget"""
+
+    return [(name, result['seconds']) for name, result in sorted(report['results'].items())
+            if name.startswith('startup/') and result['seconds'] > budget]
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Benchmark the pannellum pipeline on synthetic panoramas')
+    parser.add_argument('-o', '--output', help='Write the results as JSON to this file.')
+    parser.add_argument('-b', '--baseline', help='Results of an earlier run to compare with.')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD,
+                        help='Slowdown counted as regression. Default: %s' % THRESHOLD)
+    parser.add_argument('-p', '--panoramas', nargs='+', choices=sorted(PANORAMAS), default=DEFAULT_PANORAMAS,
+                        help='Synthetic panoramas. Default: %s' % ' '.join(DEFAULT_PANORAMAS))
+    parser.add_argument('-r', '--repeat', type=int, default=REPEAT, help='Runs per stage. Default: %s' % REPEAT)
+    parser.add_argument('--tour_scenes', type=int, default=TOUR_SCENES,
+                        help='Scenes of the synthetic tour. Default: %s' % TOUR_SCENES)
+    parser.add_argument('--startup_budget', type=float, default=STARTUP_BUDGET,
+                        help='Seconds the console scripts may take to start. Default: %s' % STARTUP_BUDGET)
+    parser.add_argument('-v', '--verbose', action="store_true", help="be verbose")
+    args = parser.parse_args()
+
+    logging.getLogger('pannellum').setLevel(logging.INFO if args.verbose else logging.ERROR)
+    logging.getLogger('pannellum').addHandler(logging.StreamHandler())
+
+    folder = tempfile.mkdtemp(prefix='pannellum-benchmark-')
+    try:
+        benchmark = Benchmark(folder, repeat=args.repeat, panoramas=args.panoramas, tour_scenes=args.tour_scenes)
+        report = benchmark.run()
+    finally:
+        shutil.rmtree(folder)
+
+    for name, result in sorted(report['results'].items()):
+        print("%-28s %8.3fs" % (name, result['seconds']))
+    for name, reason in sorted(report['skipped'].items()):
+        print("%-28s  skipped, %s" % (name, reason))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, sort_keys=True, indent=4)
+
+    failed = False
+    for name, seconds in over_budget(report, args.startup_budget):
+        print("OVER BUDGET %s: %.3fs, budget %.3fs" % (name, seconds, args.startup_budget))
+        failed = True
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        slower = regressions(report, baseline, args.threshold)
+        for name, seconds, before in slower:
+            print("REGRESSION %s: %.3fs, was %.3fs (+%d%%)" % (name, seconds, before, math.floor(100 * (seconds / before - 1))))
+        failed = failed or bool(slower)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+#!/usr/bin/env  python
+# -*- coding: utf-8 -*-
+"""Persistent caches for parsed panorama metadata and scene configurations.
+"""
+
+import datetime
+import json
+import logging
+import os
+import sqlite3
+import time
+
+from fourpi.pannellum.utils import _digest, _expand, _get_or_create_path
+
+EXIF_CACHE = '.exifcache.sqlite'
+CONF_CACHE = '.confcache.sqlite'
+# bytes of tiles kept in memory by the tile server
+TILE_CACHE_BYTES = 256 * 2 ** 20
+MAX_ENTRIES = 10000
+DATE_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+logger = logging.getLogger('pannellum.cache')
+
+
+def _default(value):
+    if isinstance(value, datetime.datetime):
+        return {'__datetime__': value.strftime(DATE_FORMAT)}
+    raise TypeError("%r is not JSON serializable" % value)
+
+
+def _object_hook(obj):
+    if '__datetime__' in obj:
+        return datetime.datetime.strptime(obj['__datetime__'], DATE_FORMAT)
+    return obj
+
+
+class MetadataCache:
+    """Metadata of panoramas, keyed by path, size and modification time.
+
+    The least recently used entries are evicted once more than
+    ``max_entries`` panoramas are stored.
+    """
+
+    def __init__(self, path, **kwargs):
+
+        self.path = _expand(path)
+        self.max_entries = kwargs.get('max_entries', MAX_ENTRIES)
+        self.hash_content = kwargs.get('hash_content', False)
+        _get_or_create_path(os.path.dirname(self.path))
+        self.db = sqlite3.connect(self.path)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS metadata (
+                               path TEXT PRIMARY KEY,
+                               size INTEGER,
+                               mtime REAL,
+                               digest TEXT,
+                               accessed REAL,
+                               data TEXT)""")
+        if kwargs.get('refresh', False):
+            self.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def _identity(self, panorama):
+        stat = os.stat(panorama)
+        digest = _digest(panorama) if self.hash_content else None
+        return stat.st_size, stat.st_mtime, digest
+
+    def get(self, panorama):
+        """return the cached values or None if missing or stale"""
+
+        key = _expand(panorama)
+        row = self.db.execute("SELECT size, mtime, digest, data FROM metadata WHERE path = ?", (key,)).fetchone()
+        if row is None or tuple(row[:3]) != self._identity(panorama):
+            self.misses += 1
+            return None
+        self.db.execute("UPDATE metadata SET accessed = ? WHERE path = ?", (time.time(), key))
+        self.hits += 1
+        values = json.loads(row[3], object_hook=_object_hook)
+        if values.get('latlng'):
+            values['latlng'] = tuple(values['latlng'])
+        return values
+
+    def set(self, panorama, values):
+        size, mtime, digest = self._identity(panorama)
+        data = json.dumps(values, default=_default)
+        self.db.execute("INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?, ?, ?)",
+                        (_expand(panorama), size, mtime, digest, time.time(), data))
+
+    def evict(self):
+        """drop the least recently used entries above max_entries"""
+
+        count = self.db.execute("SELECT COUNT(*) FROM metadata").fetchone()[0]
+        if count > self.max_entries:
+            self.db.execute("""DELETE FROM metadata WHERE path IN (
+                                   SELECT path FROM metadata ORDER BY accessed, rowid LIMIT ?)""",
+                            (count - self.max_entries,))
+            logger.info("%s entries evicted from %s", count - self.max_entries, self.path)
+
+    def clear(self):
+        self.db.execute("DELETE FROM metadata")
+        self.db.commit()
+        logger.info("Metadata cache %s cleared", self.path)
+
+    def sync(self):
+        self.evict()
+        self.db.commit()
+
+    def close(self):
+        self.sync()
+        self.db.close()
+        logger.info("Metadata cache: %s hits, %s misses", self.hits, self.misses)
+
+
+class ConfCache:
+    """Configuration of scenes from an earlier run, keyed by scene id.
+
+    An entry is only used while the fingerprint of the scene, see
+    ``Scene.fingerprint``, is the same.
+    """
+
+    def __init__(self, path, **kwargs):
+
+        self.path = _expand(path)
+        _get_or_create_path(os.path.dirname(self.path))
+        self.db = sqlite3.connect(self.path)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS conf (
+                               scene_id TEXT PRIMARY KEY,
+                               fingerprint TEXT,
+                               data TEXT)""")
+        if kwargs.get('refresh', False):
+            self.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, scene_id, fingerprint):
+        """return the cached configuration or None if missing or stale"""
+
+        row = self.db.execute("SELECT fingerprint, data FROM conf WHERE scene_id = ?", (scene_id,)).fetchone()
+        if row is None or row[0] != fingerprint:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(row[1])
+
+    def set(self, scene_id, fingerprint, conf):
+        self.db.execute("INSERT OR REPLACE INTO conf VALUES (?, ?, ?)", (scene_id, fingerprint, json.dumps(conf)))
+
+    def clear(self):
+        self.db.execute("DELETE FROM conf")
+        self.db.commit()
+        logger.info("Configuration cache %s cleared", self.path)
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+        logger.info("Configuration cache: %s hits, %s misses", self.hits, self.misses)
@@ -0,0 +1,156 @@
+#!/usr/bin/env  python
+# -*- coding: utf-8 -*-
+"""Write identical tiles only once.
+
+Blank faces of cropped panoramas and large areas of sky or floor give many
+tiles of the same content. The first one is written, the others are linked
+to it.
+"""
+
+import hashlib
+import logging
+import os
+import threading
+
+from fourpi.pannellum.metrics import metrics
+
+logger = logging.getLogger('pannellum.dedup')
+
+LINKS = ('hardlink', 'symlink')
+DEFAULT_LINK = 'hardlink'
+
+
+def _uniform_key(image):
+    """mode, size and colour of an image of a single colour, None otherwise"""
+
+    extrema = image.getextrema()
+    bands = extrema if isinstance(extrema[0], tuple) else (extrema,)
+    if any(low != high for low, high in bands):
+        return None
+    return (image.mode, image.size, tuple(low for low, high in bands))
+
+
+def _link(target, filename, link):
+    if os.path.lexists(filename):
+        os.remove(filename)
+    if link == 'symlink':
+        os.symlink(os.path.relpath(target, os.path.dirname(filename)), filename)
+    else:
+        os.link(target, filename)
+
+
+class Deduplicator:
+    """Saves images with an encoder, linking duplicates to the first copy.
+
+    Tiles of a single colour are recognised before encoding, all others by
+    the digest of their encoded bytes. Counts the tiles and the bytes saved
+    in ``stats``. Used in place of the encoder; a copy sent to a worker
+    process starts with an empty registry of its own.
+    """
+
+    writes_files = True
+
+    def __init__(self, encoder, link=DEFAULT_LINK):
+
+        if link not in LINKS:
+            raise ValueError("unknown link %s, choose from %s" % (link, ', '.join(LINKS)))
+        self.encoder = encoder
+        self.link = link
+        self.extension = encoder.extension
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """forget the files registered and the stats, e.g. before all tiles are made again"""
+
+        with self._lock:
+            self._files = {}
+            self.stats = {'tiles': 0, 'unique': 0, 'linked': 0, 'uniform': 0, 'bytes_saved': 0}
+
+    def __getstate__(self):
+        return {'encoder': self.encoder, 'link': self.link, 'extension': self.extension}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def _link_to(self, key, filename):
+        """link filename to the file registered under key, False if there is none"""
+
+        with self._lock:
+            target = self._files.get(key)
+            if not target:
+                return False
+            try:
+                _link(target, filename, self.link)
+            except OSError as e:
+                logger.debug("linking %s failed: %s", filename, e)
+                return False
+            self.stats['tiles'] += 1
+            self.stats['linked'] += 1
+            self.stats['bytes_saved'] += os.path.getsize(target)
+            return True
+
+    def save(self, image, filename):
+        uniform = _uniform_key(image)
+        if uniform and self._link_to(uniform, filename):
+            with self._lock:
+                self.stats['uniform'] += 1
+            return
+        data = self.encoder.encode(image)
+        digest = hashlib.sha1(data).hexdigest()
+        if self._link_to(digest, filename):
+            return
+        # a new file, the old one may be linked to other tiles
+        if os.path.lexists(filename):
+            os.remove(filename)
+        with open(filename, 'wb') as f:
+            f.write(data)
+        metrics.count('bytes_written', len(data))
+        with self._lock:
+            self._files.setdefault(digest, filename)
+            if uniform:
+                self._files.setdefault(uniform, filename)
+            self.stats['tiles'] += 1
+            self.stats['unique'] += 1
+
+    def sync(self):
+        self.encoder.sync()
+
+    def link_tree(self, folder):
+        """Link all identical files below folder, e.g. written by several processes.
+
+        Returns the stats of the whole folder, counting the files linked before.
+        """
+
+        self.reset()
+        inodes = set()
+        for root, dirs, files in os.walk(folder):
+            dirs.sort()
+            for name in sorted(files):
+                if not name.endswith('.' + self.extension):
+                    continue
+                filename = os.path.join(root, name)
+                if os.path.islink(filename):
+                    self.stats['tiles'] += 1
+                    self.stats['linked'] += 1
+                    self.stats['bytes_saved'] += os.path.getsize(filename)
+                    continue
+                stat = os.stat(filename)
+                if (stat.st_dev, stat.st_ino) in inodes:
+                    self.stats['tiles'] += 1
+                    self.stats['linked'] += 1
+                    self.stats['bytes_saved'] += stat.st_size
+                    continue
+                with open(filename, 'rb') as f:
+                    digest = hashlib.sha1(f.read()).hexdigest()
+                if self._link_to(digest, filename):
+                    # counted when a worker process wrote it
+                    metrics.count('bytes_written', -stat.st_size)
+                    continue
+                self._files[digest] = filename
+                inodes.add((stat.st_dev, stat.st_ino))
+                self.stats['tiles'] += 1
+                self.stats['unique'] += 1
+        return self.stats
@@ -0,0 +1,74 @@
+#!/usr/bin/env  python
+# -*- coding: utf-8 -*-
+"""Save tiles in one of the image formats pannellum can load.
+"""
+
+import io
+import logging
+
+from fourpi.pannellum.metrics import metrics
+
+logger = logging.getLogger('pannellum.encoder')
+
+# name: (Pillow format, file extension, save options)
+TILE_FORMATS = {
+    'jpg': ('JPEG', 'jpg', {}),
+    'jpg-progressive': ('JPEG', 'jpg', {'progressive': True, 'optimize': True}),
+    'jpg-optimized': ('JPEG', 'jpg', {'optimize': True}),
+    'png': ('PNG', 'png', {'optimize': True}),
+    'webp': ('WEBP', 'webp', {'method': 4}),
+    'webp-lossless': ('WEBP', 'webp', {'lossless': True, 'method': 4}),
+}
+
+# image modes each format can write, anything else is converted to RGB
+MODES = {
+    'JPEG': ('1', 'L', 'RGB', 'CMYK'),
+    'PNG': ('1', 'L', 'P', 'RGB', 'RGBA'),
+    'WEBP': ('RGB', 'RGBA'),
+}
+
+
+class Encoder:
+    """Writes images in a tile format with a quality between 0 and 100.
+
+    Plain data only, so encoders can be passed to the tiling processes.
+    """
+
+    # every image is a file, in a folder made by the tiler
+    writes_files = True
+
+    def __init__(self, tile_format='jpg', quality=80):
+
+        if tile_format not in TILE_FORMATS:
+            raise ValueError("unknown tile format %s, choose from %s" % (tile_format, ', '.join(TILE_FORMATS)))
+        self.tile_format = tile_format
+        self.format, self.extension, options = TILE_FORMATS[tile_format]
+        if self.format == 'WEBP':
+            # imported here, building a tour without tiles needs no Pillow
+            import PIL.features
+            if not PIL.features.check('webp'):
+                raise RuntimeError("Pillow was built without WebP support")
+        self.options = dict(options)
+        if self.format in ('JPEG', 'WEBP'):
+            self.options['quality'] = quality
+
+    def save(self, image, filename):
+        data = self.encode(image)
+        with metrics.stage('write'):
+            with open(filename, 'wb') as f:
+                f.write(data)
+        metrics.count('bytes_written', len(data))
+
+    def sync(self):
+        """store what was saved for good, the files are already written"""
+
+    def encode(self, image):
+        """return the encoded image as bytes"""
+
+        with metrics.stage('encode'):
+            if image.mode not in MODES[self.format]:
+                image = image.convert('RGB')
+            buffer = io.BytesIO()
+            image.save(buffer, self.format, **self.options)
+        metrics.count('encoded_bytes', buffer.tell())
+        return buffer.getvalue()
@@ -1,52 +1,177 @@
 #!/usr/bin/env  python
 # -*- coding: utf-8 -*-
+"""Remap panoramas from equirectangular to cylindrical projection.
 
+In process with NumPy, or with hugins nona. Many panoramas are converted
+at once by a pool of worker processes.
+"""
 
+import argparse
+import concurrent.futures
+import logging
 import math
-import subprocess
 import os
-import argparse
-import PIL.Image
+import subprocess
+import sys
+import time
+
+from fourpi.pannellum import remap
+from fourpi.pannellum.metrics import metrics
+from fourpi.pannellum.utils import _expand, _get_or_create_path, find_tool, Image
+
+REMAPPERS = ('nona', 'numpy')
+DEFAULT_REMAPPER = 'numpy' if remap.numpy else 'nona'
+DEFAULT_VFOV = 130.0
+# nona's interpolator, 2 is spline36
+DEFAULT_INTERPOLATOR = 2
+# rows remapped at once by numpy
+ROWS = 256
+
+logger = logging.getLogger('pannellum.eq2cyl')
+
+
+def cylinder_size(width, vfov=DEFAULT_VFOV, cyl_width=None):
+    """width and height of the cylindrical panorama of an equirectangular one"""
+
+    cyl_width = cyl_width or width
+    cyl_height = 2 * (cyl_width / (2 * math.pi) * math.tan(math.radians(vfov / 2)))
+    return int(cyl_width), int(cyl_height)
+
+
+def _names(panorama, output_dir=''):
+    base = os.path.join(output_dir, os.path.splitext(os.path.basename(panorama))[0])
+    return base + "-cyl.pto", base + "-cyl.tif"
+
+
+def _make_script(panorama, script_name, size, cyl_size, interpolator=DEFAULT_INTERPOLATOR):
+    """Write the nona script remapping the panorama to a cylinder"""
+
+    with open(script_name, 'w') as script:
+        script.write('p f1 w%s h%s n"TIFF" u0 v360\n' % cyl_size)
+        script.write('m i%s\n' % interpolator)
+        script.write('i f4 w%s h%s r0 p0 y0 v360 n"%s"\n' % (size[0], size[1], panorama))
+
+
+@metrics.timed('eq2cyl.nona', process=True)
+def _remap_nona(panorama, out_name, script_name, size, cyl_size, interpolator=DEFAULT_INTERPOLATOR):
+    if not find_tool('nona'):
+        raise RuntimeError("nona required but not found")
+    _make_script(panorama, script_name, size, cyl_size, interpolator)
+    result = subprocess.run([find_tool('nona'), '-o', out_name, script_name], capture_output=True, text=True)
+    if result.returncode:
+        raise RuntimeError("nona failed with %s: %s" % (result.returncode, result.stderr.strip()))
+
+
+@metrics.timed('eq2cyl.numpy')
+def _remap_numpy(image, out_name, cyl_size, interpolation=remap.DEFAULT_INTERPOLATION):
+    if not remap.numpy:
+        raise RuntimeError("numpy is required to remap in process")
+    source = remap.numpy.asarray(image.convert('RGB'))
+    height, width = source.shape[:2]
+    cyl_width, cyl_height = cyl_size
+    cylinder = remap.numpy.empty((cyl_height, cyl_width, 3), dtype=remap.numpy.uint8)
+    for first in range(0, cyl_height, ROWS):
+        last = min(first + ROWS, cyl_height)
+        x, y = remap.cylinder_coordinates(cyl_width, cyl_height, width, height, (first, last))
+        cylinder[first:last] = remap.sample(source, x, y, interpolation)[..., :3]
+    Image.fromarray(cylinder, 'RGB').save(out_name, 'TIFF')
+
+
+def convert(panorama, **kwargs):
+    """Remap a panorama to cylindrical projection, returns the file written.
+
+    The TIFF is named after the panorama with ``-cyl`` appended and written
+    to ``output_dir``, the current directory by default.
+    """
+
+    remapper = kwargs.get('remapper', DEFAULT_REMAPPER)
+    if remapper not in REMAPPERS:
+        raise ValueError("unknown remapper %s, choose from %s" % (remapper, ', '.join(REMAPPERS)))
+    output_dir = kwargs.get('output_dir', '')
+    if output_dir:
+        _get_or_create_path(output_dir)
+    script_name, out_name = _names(panorama, output_dir)
+    with Image.open(_expand(panorama)) as image:
+        cyl_size = cylinder_size(image.width, kwargs.get('vfov', DEFAULT_VFOV), kwargs.get('width', None))
+        if remapper == 'nona':
+            _remap_nona(panorama, out_name, script_name, image.size, cyl_size,
+                        kwargs.get('interpolator', DEFAULT_INTERPOLATOR))
+        else:
+            _remap_numpy(image, out_name, cyl_size, kwargs.get('interpolation', remap.DEFAULT_INTERPOLATION))
+    logger.info("%s remapped to %s, %sx%s", panorama, out_name, *cyl_size)
+    return out_name
+
+
+def _convert_timed(panorama, kwargs):
+    """convert, returns the file written or the error and the seconds it took"""
+
+    start = time.perf_counter()
+    try:
+        out_name, error = convert(panorama, **kwargs), None
+    except Exception as e:
+        logger.debug("%s failed", panorama, exc_info=True)
+        out_name, error = None, "%s: %s" % (type(e).__name__, e)
+    return panorama, out_name, error, time.perf_counter() - start
+
+
+def convert_all(panoramas, jobs=1, **kwargs):
+    """Convert the panoramas, jobs at a time in worker processes.
+
+    Yields (panorama, file written, error, seconds) as they are done, a
+    failing panorama does not stop the others.
+    """
+
+    if jobs <= 1 or len(panoramas) <= 1:
+        for panorama in panoramas:
+            yield _convert_timed(panorama, kwargs)
+        return
+    with concurrent.futures.ProcessPoolExecutor(jobs) as pool:
+        futures = [pool.submit(_convert_timed, panorama, kwargs) for panorama in panoramas]
+        for future in concurrent.futures.as_completed(futures):
+            yield future.result()
 
-from distutils.spawn import find_executable
-    
-NONA = find_executable('nona')
 
 def main():
     parser = argparse.ArgumentParser(description='Remap panoramas from equirectangular to cylindrical projection')
-    parser.add_argument('panorama', metavar='INPUT', help='Panoramic image')
+    parser.add_argument('panoramas', nargs='+', metavar='INPUT', help='Panoramic image(s)')
     parser.add_argument('-f', '--vfov', type=float,
-                            default=130.0, help='Vertical Field of View in degree. Default: 130')
+                        default=DEFAULT_VFOV, help='Vertical Field of View in degree. Default: 130')
     parser.add_argument('-i', '--interpolator', type=int,
-                            default=2, help='Interpolator used for remapping.')
+                        default=DEFAULT_INTERPOLATOR, help='Interpolator used by nona. Default: 2')
+    parser.add_argument('--interpolation', choices=remap.INTERPOLATIONS, default=remap.DEFAULT_INTERPOLATION,
+                        help='Interpolation of the numpy remapper. Default: %s' % remap.DEFAULT_INTERPOLATION)
     parser.add_argument('-w', '--width', type=int,
-                             help='Width of output in px. Default: original width.')
-
+                        help='Width of output in px. Default: original width.')
+    parser.add_argument('-o', '--output_dir', default='',
+                        help='Folder of the cylindrical panoramas. Default: the current directory')
+    parser.add_argument('--remapper', choices=REMAPPERS, default=DEFAULT_REMAPPER,
+                        help='Remap with nona or in process with numpy. Default: %s' % DEFAULT_REMAPPER)
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of panoramas remapped concurrently. Default: 1')
+    parser.add_argument("-v", "--verbose", action="store_true", help="be verbose")
 
     args = parser.parse_args()
-    print(args)
-
-    pano = PIL.Image.open(args.panorama)
-    width, height = pano.size
-    if args.width:
-        cyl_width = args.width
-    else:
-        cyl_width = width
-    
-    interpolator = args.interpolator
-
-    base = os.path.splitext(os.path.basename(args.panorama))[0]
-    script_name = base + "-cyl.pto"
-    out_name = base + "-cyl.tif"
 
-    cyl_height = 2 * (cyl_width / (2 * math.pi) * math.tan(math.radians(args.vfov / 2)))
-    print(cyl_width, int(cyl_height))
+    logging.getLogger('pannellum').setLevel(logging.INFO if args.verbose else logging.WARN)
+    logging.getLogger('pannellum').addHandler(logging.StreamHandler())
 
-    script = open(script_name, 'w')
-    script.write('p f1 w%s h%s n"TIFF" u0 v360\n' % (int(cyl_width), int(cyl_height)))
-    script.write('m i%s\n' % interpolator)
-    script.write('i f4 w%s h%s r0 p0 y0 v360 n"%s"\n' % (width, height, args.panorama))
+    failed = 0
+    for panorama, out_name, error, seconds in convert_all(args.panoramas, args.jobs,
+                                                          vfov=args.vfov,
+                                                          interpolator=args.interpolator,
+                                                          interpolation=args.interpolation,
+                                                          width=args.width,
+                                                          output_dir=args.output_dir,
+                                                          remapper=args.remapper):
+        if error:
+            failed += 1
+            print("%s FAILED after %.2fs: %s" % (panorama, seconds, error))
+        else:
+            print("%s -> %s %.2fs" % (panorama, out_name, seconds))
+    if failed:
+        print("%s of %s panoramas failed" % (failed, len(args.panoramas)))
+        sys.exit(1)
 
-    args = [NONA, '-v', '-o', out_name, script_name]
-    p = subprocess.Popen(args)
 
+if __name__ == "__main__":
+    main()
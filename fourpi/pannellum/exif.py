@@ -3,25 +3,24 @@
 """Parse panorama specific exif metadata.
 """
 
-from distutils.spawn import find_executable
 import argparse
+import concurrent.futures
 import datetime
+import glob
 import json
+import math
 import os
+import re
 import subprocess
 import logging
 
-from fourpi.pannellum.utils import _scene_id_from_image
-
-EXIFTOOL = find_executable('exiftool')
+from fourpi.pannellum.metrics import metrics
+from fourpi.pannellum import jpeg
+from fourpi.pannellum.cache import MetadataCache
+from fourpi.pannellum.utils import _scene_id_from_image, _get_or_create_path, find_tool
 
 logger = logging.getLogger('pannellum.exif')
 
-if EXIFTOOL:
-    logger.info("exiftool found at %s" % EXIFTOOL)
-else:
-    logger.error("EXIFTOOL required but not found.")
-
 mapping = (
     ('title', 'DocumentName', '', 'string'),
     ('width', 'ImageWidth', 0, 'int'),
@@ -52,54 +51,164 @@ gpano = (
     ('panoWidth', 'FullPanoWidthPixels', None, 'int')
 )
 
+# number of panoramas read by a single exiftool call
+BATCH_SIZE = 500
+# python reads JPEG files itself, auto as well but leaves other files to exiftool
+BACKENDS = ('auto', 'python', 'exiftool')
+DEFAULT_BACKEND = 'auto'
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.tif', '.tiff')
+
+RST = """%(title)s
+%(underline)s
+
+:date:     %(date)s
+:category: Panoramas
+:tags:
+:template: panorama
+:scene_id: %(scene_id)s
+"""
+RST_FIELD = "%-12s: %s"
+RST_DATE = re.compile(r'^:date:\s+(.*)$', re.MULTILINE)
+
+
+def _positive_int(text):
+    value = int(text)
+    if value < 1:
+        raise argparse.ArgumentTypeError("%s is not a positive number" % text)
+    return value
+
 
 class Exif:
 
     def __init__(self, panoramas=[], **kwargs):
 
         self.panoramas = panoramas
+        self.batch_size = kwargs.get('batch_size', BATCH_SIZE)
+        self.cache = kwargs.get('cache', None)
+        self.jobs = kwargs.get('jobs', 1)
+        if self.jobs < 1:
+            raise ValueError("jobs must be at least 1, not %s" % self.jobs)
+        self.backend = kwargs.get('backend', DEFAULT_BACKEND)
+        if self.backend not in BACKENDS:
+            raise ValueError("unknown backend %s, choose from %s" % (self.backend, ', '.join(BACKENDS)))
+
+    def _read_batch(self, panoramas):
+        """Read the metadata of several panoramas with a single exiftool call.
+
+        The filenames are passed on stdin (``-@ -``), so the command line
+        does not grow with the number of panoramas. Returns a dictionary
+        mapping each filename to its raw exiftool tags.
+        """
+
+        exiftool = find_tool('exiftool')
+        if not exiftool:
+            logger.error("exiftool required to read %s but not found", ', '.join(panoramas))
+            return {}
+        argfile = '\n'.join(panoramas) + '\n'
+        with metrics.stage('exif.exiftool'):
+            exifjson = subprocess.run([exiftool, '-j', '-n', '-charset', 'filename=utf8', '-@', '-'],
+                                      input=argfile.encode('utf-8'), stdout=subprocess.PIPE).stdout.decode('utf-8')
+        metrics.count('exiftool_calls')
+        if not exifjson.strip():
+            return {}
+        return dict((exif.get('SourceFile'), exif) for exif in json.loads(exifjson))
+
+    def _parse(self, scene_id, exif):
+        """Convert raw exiftool tags into the values used by the scenes."""
+
+        values = {}
+        for conf, tag, default, type in mapping:
+            if tag not in exif:
+                value = default
+                logger.warn("%s: missing %s (default=%s)", scene_id, tag, default)
+            else:
+                value = exif[tag]
+                logger.info("%s: %s", tag, value)
+            if value and type == 'date':
+                value = datetime.datetime.strptime(value, "%Y:%m:%d %H:%M:%S")
+            if type == 'lines' and value:
+                value = value.split('\n')
+            if conf == 'exposure' and value:
+                try:
+                    value = int(1 / value)
+                except:
+                    value = 0
+            values[conf] = value
+
+        if values['lat'] and values['lng']:
+            values['latlng'] = (values['lat'], values['lng'])
+
+        for conf, tag, default, type in gpano:
+            if tag in exif:
+                value = exif[tag]
+                logger.info("%s: %s", tag, value)
+                values[conf] = float(value)
+
+        return values
+
+    def _add(self, exifdata, panorama, exif):
+        scene_id = _scene_id_from_image(panorama)
+        exifdata[scene_id] = self._parse(scene_id, exif)
+        logger.info("EXIF data read from %s", panorama)
+        if self.cache:
+            self.cache.set(panorama, exifdata[scene_id])
 
+    def _read_tags(self, panoramas):
+        """tags of the JPEG panoramas read in python, jobs files at a time"""
+
+        if self.jobs <= 1 or len(panoramas) <= 1:
+            return [jpeg.read_tags(panorama) for panorama in panoramas]
+        with concurrent.futures.ThreadPoolExecutor(self.jobs) as pool:
+            return list(pool.map(jpeg.read_tags, panoramas))
+
+    @metrics.timed('exif')
     def get_exifdata(self):
 
         exifdata = {}
+        unread = []
         for panorama in self.panoramas:
-            scene_id = _scene_id_from_image(panorama)
             if not os.path.isfile(panorama):
                 logger.error("File not found: %s", panorama)
-                break
-            exifjson = subprocess.check_output([EXIFTOOL, '-j', '-n', panorama]).decode('utf-8')
-            exif = json.loads(exifjson)[0]
-            values = {}
-            for conf, tag, default, type in mapping:
-                if tag not in exif:
-                    value = default
-                    logger.warn("%s: missing %s (default=%s)", scene_id, tag, default)
+                continue
+            if self.cache:
+                values = self.cache.get(panorama)
+                if values is not None:
+                    exifdata[_scene_id_from_image(panorama)] = values
+                    metrics.count('exif_cache_hits')
+                    logger.info("EXIF data of %s read from cache", panorama)
+                    continue
+            unread.append(panorama)
+
+        panoramas = []
+        if self.backend == 'exiftool':
+            panoramas = unread
+        else:
+            # the jobs read in threads, the pool spans other threads
+            with metrics.stage('exif.python', process=True):
+                exifs = self._read_tags(unread)
+            for panorama, exif in zip(unread, exifs):
+                if exif is not None:
+                    self._add(exifdata, panorama, exif)
+                elif self.backend == 'python':
+                    logger.error("No EXIF data read from %s", panorama)
                 else:
-                    value = exif[tag]
-                    logger.info("%s: %s", tag, value)
-                if value and type == 'date':
-                    value = datetime.datetime.strptime(value, "%Y:%m:%d %H:%M:%S")
-                if type == 'lines' and value:
-                    value = value.split('\n')
-                if conf == 'exposure' and value:
-                    try:
-                        value = int(1 / value)
-                    except:
-                        value = 0
-                values[conf] = value
-
-            if values['lat'] and values['lng']:
-                values['latlng'] = (values['lat'], values['lng'])
-
-            for conf, tag, default, type in gpano:
-                if tag in exif:
-                    value = exif[tag]
-                    logger.info("%s: %s", tag, value)
-                    values[conf] = float(value)
-
-            exifdata[scene_id] = values
-            logger.info("EXIF data read from %s", panorama)
+                    panoramas.append(panorama)
 
+        # smaller batches to keep all exiftool processes busy
+        batch_size = max(1, min(self.batch_size, math.ceil(len(panoramas) / self.jobs)))
+        batches = [panoramas[start:start + batch_size] for start in range(0, len(panoramas), batch_size)]
+        with concurrent.futures.ThreadPoolExecutor(self.jobs) as pool:
+            results = list(pool.map(self._read_batch, batches))
+        for batch, exifs in zip(batches, results):
+            for panorama in batch:
+                exif = exifs.get(panorama, None)
+                if exif is None:
+                    logger.error("No EXIF data read from %s", panorama)
+                    continue
+                self._add(exifdata, panorama, exif)
+
+        if self.cache:
+            self.cache.sync()
         return exifdata
 
 
@@ -107,38 +216,89 @@ def now():
     return datetime.datetime.now().strftime('%Y-%m-%d')
 
 
+def find_panoramas(inputs):
+    """Return the images given as files, directories or glob patterns, each once"""
+
+    panoramas = []
+    for name in inputs:
+        if os.path.isdir(name):
+            found = [os.path.join(name, f) for f in sorted(os.listdir(name))
+                     if os.path.splitext(f)[1].lower() in IMAGE_EXTENSIONS]
+        elif glob.has_magic(name):
+            found = sorted(glob.glob(name))
+        else:
+            found = [name]
+        panoramas.extend(panorama for panorama in found if panorama not in panoramas)
+    return panoramas
+
+
+def rst(scene_id, exif, date=None):
+    """Return the pelican page of a scene, dated today unless date is given"""
+
+    values = dict(exif)
+    if values['title'] == '':
+        values['title'] = scene_id
+        logger.warning('%s: no title found, using scene_id', scene_id)
+    values['underline'] = '=' * len(values['title'])
+    values['scene_id'] = scene_id
+    values['date'] = date or now()
+    return RST % values + '\n' + ''.join(RST_FIELD % (k, v) + '\n' for k, v in values.items())
+
+
+def write_rst(filename, scene_id, exif):
+    """Write the pelican page of a scene unless it is unchanged, returns True if written.
+
+    The date of an existing page is kept.
+    """
+
+    date = None
+    if os.path.isfile(filename):
+        with open(filename) as f:
+            old = f.read()
+        match = RST_DATE.search(old)
+        date = match.group(1) if match else None
+        if old == rst(scene_id, exif, date):
+            return False
+    with open(filename, 'w') as f:
+        f.write(rst(scene_id, exif, date))
+    return True
+
+
 def main():
 
     parser = argparse.ArgumentParser(description='Create pelican rst file from exif')
-    parser.add_argument('panorama', metavar='INPUT', help='Panoramic image')
+    parser.add_argument('panoramas', nargs='+', metavar='INPUT',
+                        help='Panoramic image(s), folders of them or glob patterns')
+    parser.add_argument('-o', '--output_dir',
+                        help='Write a <scene_id>.rst per panorama into this folder. Default: print them')
+    parser.add_argument('-j', '--jobs', type=_positive_int, default=1,
+                        help='Number of files read at once, by exiftool processes or python threads. Default: 1')
+    parser.add_argument('--exif_cache', help='Metadata cache file, see pannellum.')
+    parser.add_argument('--backend', choices=BACKENDS, default=DEFAULT_BACKEND,
+                        help='Read JPEG metadata in python, other files with exiftool (auto), or all with one of them. '
+                             'Default: %s' % DEFAULT_BACKEND)
 
     args = parser.parse_args()
 
-    e = Exif([args.panorama])
-    scene_id = _scene_id_from_image(args.panorama)
-    fmt = "%-12s: %s"
-
-    rst = """%(title)s
-%(underline)s
-
-:date:     %(date)s
-:category: Panoramas
-:tags:
-:template: panorama
-:scene_id: %(scene_id)s
-"""
+    cache = MetadataCache(args.exif_cache) if args.exif_cache else None
+    panoramas = find_panoramas(args.panoramas)
+    exifs = Exif(panoramas, cache=cache, jobs=args.jobs, backend=args.backend).get_exifdata()
+    if cache:
+        cache.close()
 
-    exifs = Exif([args.panorama]).get_exifdata()
-    exif = exifs.get(scene_id, None)
-    if exif['title'] == '':
-        exif['title'] = scene_id
-        logger.warn('No title found, using scene_id')
-    exif['underline'] = '=' * len(exif['title'])
-    exif['scene_id'] = scene_id
-    exif['date'] = now()
-    print(rst % exif)
-    for k, v in exif.items():
-        print(fmt % (k, v))
+    written = 0
+    for panorama in panoramas:
+        scene_id = _scene_id_from_image(panorama)
+        exif = exifs.get(scene_id, None)
+        if exif is None:
+            continue
+        if not args.output_dir:
+            print(rst(scene_id, exif), end='')
+            continue
+        if write_rst(os.path.join(_get_or_create_path(args.output_dir), scene_id + '.rst'), scene_id, exif):
+            written += 1
+    if args.output_dir:
+        print("%s of %s pages written, %s unchanged" % (written, len(exifs), len(exifs) - written))
 
 
 if __name__ == "__main__":
@@ -1,8 +1,9 @@
 #!/usr/bin/env  python
 
-from fourpi.pannellum.utils import haversine
-import math
+from fourpi.pannellum.utils import haversine, bearing, hotspot_yaws
 import logging
+import math
+from fourpi.pannellum import utils
 from fourpi.pannellum.utils import _pretty_distance
 
 logger = logging.getLogger('pannellum.hotspot')
@@ -40,22 +41,7 @@ class HotSpot:
         """
 
         if hasattr(self, 'gps'):
-            lat1 = self.src['latlng'][0]
-            lng1 = self.src['latlng'][1]
-
-            lat2 = self.dest['latlng'][0]
-            lng2 = self.dest['latlng'][1]
-
-            rlat1 = math.radians(lat1)
-            rlat2 = math.radians(lat2)
-            # rlng1 = math.radians(lng1)
-            # rlng2 = math.radians(lng2)
-            dlng = math.radians(lng2 - lng1)
-            # bearing calc
-            b = math.atan2(math.sin(dlng) * math.cos(rlat2), math.cos(rlat1) * math.sin(rlat2) - math.sin(rlat1) * math.cos(rlat2) * math.cos(dlng))
-            bd = math.degrees(b)
-            bn = (bd + 360) % 360
-            return bn
+            return bearing(self.src['latlng'], self.dest['latlng'])
         else:
             return 0
 
@@ -63,15 +49,50 @@ class HotSpot:
         """Return the hotspots configuration dictionary.
         """
 
-        title = self.text
-        yaw = self._get_bearing() - self.northOffset
-        targetYaw = yaw + self.northOffset - self.targetNorthOffset
-        conf = {}
-        conf['type'] = "scene"
-        conf['text'] = "%s (%s)" % (title, self._get_distance())
-        conf['yaw'] = (yaw + 360) % 360
-        conf['pitch'] = 0
-        conf['targetPitch'] = 0
-        conf['targetYaw'] = (targetYaw + 360) % 360
-        conf['sceneId'] = self.scene_id
-        return conf
+        yaw, targetYaw = hotspot_yaws(self._get_bearing(), self.northOffset, self.targetNorthOffset)
+        return _conf(self.scene_id, self.text, self._get_distance(), yaw, targetYaw)
+
+
+def _conf(scene_id, title, distance, yaw, targetYaw):
+    conf = {}
+    conf['type'] = "scene"
+    conf['text'] = "%s (%s)" % (title, distance)
+    conf['yaw'] = yaw
+    conf['pitch'] = 0
+    conf['targetPitch'] = 0
+    conf['targetYaw'] = targetYaw
+    conf['sceneId'] = scene_id
+    return conf
+
+
+def get_confs(exifdata, neighbours):
+    """Return the hotspot configurations of many scenes in one vectorized pass.
+
+    ``neighbours`` maps the id of each source scene to the ids of the scenes
+    it links to. Returns a dictionary with a list of hotspots per source
+    scene, the same as HotSpot.get_conf would create one by one.
+    """
+
+    numpy = utils.numpy
+    scene_ids = list(exifdata.keys())
+    index = dict((scene_id, i) for i, scene_id in enumerate(scene_ids))
+    latlngs = numpy.array([exifdata[scene_id].get('latlng') or (numpy.nan, numpy.nan) for scene_id in scene_ids],
+                          dtype=float).reshape(-1, 2)
+    northOffsets = numpy.array([exifdata[scene_id].get('northOffset', 0) for scene_id in scene_ids], dtype=float)
+    titles = [exifdata[scene_id].get('title', 'n/a') for scene_id in scene_ids]
+
+    src = numpy.array([index[scene_id] for scene_id in neighbours for dest in neighbours[scene_id]], dtype=int)
+    dest = numpy.array([index[dest] for scene_id in neighbours for dest in neighbours[scene_id]], dtype=int)
+    lat1, lng1 = latlngs[src].T
+    lat2, lng2 = latlngs[dest].T
+    # pairs without GPS get no distance and a bearing of 0, like HotSpot
+    distances = utils.haversine_pairs(lat1, lng1, lat2, lng2)
+    bearings = numpy.nan_to_num(utils.bearing_pairs(lat1, lng1, lat2, lng2))
+    yaws, targetYaws = hotspot_yaws(bearings, northOffsets[src], northOffsets[dest])
+
+    confs = dict((scene_id, []) for scene_id in neighbours)
+    pairs = zip(src.tolist(), dest.tolist(), distances.tolist(), yaws.tolist(), targetYaws.tolist())
+    for i, j, distance, yaw, targetYaw in pairs:
+        distance = "" if math.isnan(distance) else _pretty_distance(distance)
+        confs[scene_ids[i]].append(_conf(scene_ids[j], titles[j], distance, yaw, targetYaw))
+    return confs
@@ -0,0 +1,241 @@
+#!/usr/bin/env  python
+# -*- coding: utf-8 -*-
+"""Read the EXIF and GPano XMP metadata of JPEG files without exiftool.
+
+Only the segments in front of the image data are read, never the pixels.
+The tags are named and valued like in the JSON of ``exiftool -j -n``, as
+far as ``Exif`` uses them.
+"""
+
+import logging
+import struct
+import xml.etree.ElementTree as ElementTree
+
+logger = logging.getLogger('pannellum.jpeg')
+
+EXIF_HEADER = b'Exif\x00\x00'
+XMP_HEADER = b'http://ns.adobe.com/xap/1.0/\x00'
+GPANO = 'http://ns.google.com/photos/1.0/panorama/'
+
+# start of frame markers, giving the size of the image
+SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+SOS = 0xDA
+EOI = 0xD9
+
+EXIF_IFD = 0x8769
+GPS_IFD = 0x8825
+IFD0_TAGS = {
+    0x010D: 'DocumentName',
+    0x010F: 'Make',
+    0x0110: 'Model',
+}
+EXIF_TAGS = {
+    0x829A: 'ExposureTime',
+    0x829D: 'FNumber',
+    0x8827: 'ISO',
+    0x9003: 'DateTimeOriginal',
+    0x920A: 'FocalLength',
+    0x9286: 'UserComment',
+    0xA434: 'LensModel',
+}
+GPS_TAGS = {
+    0x0001: 'GPSLatitudeRef',
+    0x0002: 'GPSLatitude',
+    0x0003: 'GPSLongitudeRef',
+    0x0004: 'GPSLongitude',
+    0x0011: 'GPSImgDirection',
+}
+GPANO_TAGS = (
+    'InitialViewHeadingDegrees',
+    'InitialViewPitchDegrees',
+    'InitialHorizontalFOVDegrees',
+    'SourcePhotosCount',
+    'CroppedAreaImageHeightPixels',
+    'CroppedAreaImageWidthPixels',
+    'CroppedAreaLeftPixels',
+    'CroppedAreaTopPixels',
+    'FullPanoHeightPixels',
+    'FullPanoWidthPixels',
+)
+
+# size and struct format of the TIFF field types
+TYPES = {
+    1: (1, 'B'),
+    2: (1, 's'),
+    3: (2, 'H'),
+    4: (4, 'L'),
+    5: (8, 'LL'),
+    6: (1, 'b'),
+    7: (1, 's'),
+    8: (2, 'h'),
+    9: (4, 'l'),
+    10: (8, 'll'),
+    11: (4, 'f'),
+    12: (8, 'd'),
+}
+
+
+def _text(data):
+    data = data.split(b'\x00', 1)[0]
+    try:
+        return data.decode('utf-8').strip()
+    except UnicodeDecodeError:
+        return data.decode('latin-1').strip()
+
+
+def _value(order, kind, count, data):
+    size, fmt = TYPES[kind]
+    if fmt == 's':
+        return data[:count]
+    values = struct.unpack(order + fmt * count, data[:size * count])
+    if kind in (5, 10):
+        values = [numerator / denominator if denominator else 0.0
+                  for numerator, denominator in zip(values[::2], values[1::2])]
+    return values[0] if count == 1 else list(values)
+
+
+def _read_ifd(tiff, order, offset):
+    """return the entries of the IFD at offset as {tag: (type, value)}"""
+
+    entries = {}
+    (count,) = struct.unpack(order + 'H', tiff[offset:offset + 2])
+    for i in range(count):
+        entry = offset + 2 + 12 * i
+        tag, kind, number = struct.unpack(order + 'HHL', tiff[entry:entry + 8])
+        if kind not in TYPES:
+            continue
+        size = TYPES[kind][0] * number
+        if size > 4:
+            (pointer,) = struct.unpack(order + 'L', tiff[entry + 8:entry + 12])
+            data = tiff[pointer:pointer + size]
+        else:
+            data = tiff[entry + 8:entry + 12]
+        if len(data) < size:
+            logger.debug("entry %s beyond the EXIF segment", tag)
+            continue
+        entries[tag] = (kind, _value(order, kind, number, data))
+    return entries
+
+
+def _user_comment(data):
+    # 8 bytes character code, then the comment
+    code, comment = data[:8], data[8:]
+    if code.startswith(b'UNICODE'):
+        encoding = 'utf-16-be' if comment[:2] != b'\xff\xfe' else 'utf-16'
+        return comment.decode(encoding, 'replace').rstrip('\x00').strip()
+    return _text(comment)
+
+
+def _add(tags, names, entries):
+    for tag, name in names.items():
+        if tag not in entries:
+            continue
+        kind, value = entries[tag]
+        if name == 'UserComment':
+            value = _user_comment(value)
+        elif kind in (2, 7):
+            value = _text(value)
+        tags[name] = value
+
+
+def _parse_exif(tiff):
+    """the tags of IFD0, the EXIF and the GPS IFD of a TIFF structure"""
+
+    order = {b'II': '<', b'MM': '>'}.get(tiff[:2])
+    if order is None or struct.unpack(order + 'H', tiff[2:4])[0] != 42:
+        raise ValueError("not a TIFF header")
+    tags = {}
+    ifd0 = _read_ifd(tiff, order, struct.unpack(order + 'L', tiff[4:8])[0])
+    _add(tags, IFD0_TAGS, ifd0)
+    if EXIF_IFD in ifd0:
+        _add(tags, EXIF_TAGS, _read_ifd(tiff, order, ifd0[EXIF_IFD][1]))
+    if GPS_IFD in ifd0:
+        gps = {}
+        _add(gps, GPS_TAGS, _read_ifd(tiff, order, ifd0[GPS_IFD][1]))
+        # signed decimal degrees like the composite tags of exiftool
+        for name, negative in (('GPSLatitude', 'S'), ('GPSLongitude', 'W')):
+            dms = gps.get(name)
+            if isinstance(dms, list) and len(dms) == 3:
+                degrees = dms[0] + dms[1] / 60 + dms[2] / 3600
+                tags[name] = -degrees if gps.get(name + 'Ref') == negative else degrees
+        if 'GPSImgDirection' in gps:
+            tags['GPSImgDirection'] = gps['GPSImgDirection']
+    return tags
+
+
+def _number(text):
+    try:
+        return int(text)
+    except ValueError:
+        return float(text)
+
+
+def _parse_xmp(packet):
+    """the GPano properties of an XMP packet, as attributes or elements"""
+
+    tags = {}
+    root = ElementTree.fromstring(packet.strip(b'\x00 \n\r\t'))
+    for element in root.iter():
+        values = list(element.attrib.items())
+        if element.text and element.text.strip():
+            values.append((element.tag, element.text))
+        for key, value in values:
+            if not key.startswith('{%s}' % GPANO):
+                continue
+            name = key[len(GPANO) + 2:]
+            if name in GPANO_TAGS:
+                try:
+                    tags[name] = _number(value.strip())
+                except ValueError:
+                    logger.debug("GPano %s is not a number: %s", name, value)
+    return tags
+
+
+def read_tags(filename):
+    """Return the tags of a JPEG file, None if it is no JPEG or cannot be read.
+
+    Reading stops at the start of the image data.
+    """
+
+    tags = {'SourceFile': filename}
+    try:
+        with open(filename, 'rb') as f:
+            if f.read(2) != b'\xff\xd8':
+                return None
+            while True:
+                byte = f.read(1)
+                if not byte:
+                    break
+                if byte != b'\xff':
+                    continue
+                marker = f.read(1)
+                while marker == b'\xff':
+                    marker = f.read(1)
+                if not marker:
+                    break
+                marker = marker[0]
+                if marker in (SOS, EOI):
+                    break
+                # markers without a segment
+                if 0xD0 <= marker <= 0xD7 or marker == 0x01:
+                    continue
+                (length,) = struct.unpack('>H', f.read(2))
+                if marker in SOF_MARKERS:
+                    height, width = struct.unpack('>xHH', f.read(5))
+                    tags['ImageWidth'] = width
+                    tags['ImageHeight'] = height
+                    f.seek(length - 7, 1)
+                elif marker == 0xE1:
+                    segment = f.read(length - 2)
+                    if segment.startswith(EXIF_HEADER):
+                        tags.update(_parse_exif(segment[len(EXIF_HEADER):]))
+                    elif segment.startswith(XMP_HEADER):
+                        tags.update(_parse_xmp(segment[len(XMP_HEADER):]))
+                else:
+                    f.seek(length - 2, 1)
+    except (OSError, struct.error, ValueError, KeyError, ElementTree.ParseError) as e:
+        logger.info("%s not read: %s", filename, e)
+        return None
+    if 'ImageWidth' not in tags:
+        return None
+    return tags
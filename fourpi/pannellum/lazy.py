@@ -0,0 +1,253 @@
+#!/usr/bin/env  python
+# -*- coding: utf-8 -*-
+"""Render the tiles of a tour when they are first requested.
+
+Instead of tiling every level of every face in advance, the tiles are cut
+from the extracted faces, or remapped from the panorama with NumPy, once a
+viewer asks for them. The URLs are the same as of the tile folders,
+``/<scene>/<level>/<face><y>_<x>.<ext>`` and ``/<scene>/fallback/<face>.<ext>``.
+"""
+
+import collections
+import functools
+import http.server
+import logging
+import math
+import os
+import re
+import threading
+
+from fourpi.pannellum import remap
+from fourpi.pannellum.encoder import Encoder
+from fourpi.pannellum.cache import TILE_CACHE_BYTES as CACHE_BYTES
+from fourpi.pannellum.scene import ANGLES, FACES, FALLBACK_SIZE, _resize_filter
+from fourpi.pannellum.utils import _expand, _get_or_create_path, Image
+# panoramas and faces kept decoded
+MAX_SOURCES = 2
+# lower levels are remapped at up to this multiple of their size, then scaled down
+SUPERSAMPLING = 4
+# rows of tiles are rendered under one of a fixed number of locks
+ROW_LOCKS = 64
+
+TILE = re.compile(r'^([1-9]\d*)/([fblrud])(0|[1-9]\d*)_(0|[1-9]\d*)\.(\w+)$')
+FALLBACK = re.compile(r'^fallback/([fblrud])\.(\w+)$')
+CONTENT_TYPES = {
+    'jpg': 'image/jpeg',
+    'png': 'image/png',
+    'webp': 'image/webp',
+}
+
+logger = logging.getLogger('pannellum.lazy')
+
+
+class LRUCache:
+    """A dict of bytes holding at most max_bytes, dropping the least recently used."""
+
+    def __init__(self, max_bytes=CACHE_BYTES):
+
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            if key in self._items:
+                self.bytes -= len(self._items.pop(key))
+            self._items[key] = value
+            self.bytes += len(value)
+            while self.bytes > self.max_bytes and len(self._items) > 1:
+                self.bytes -= len(self._items.popitem(last=False)[1])
+
+
+def _level_sizes(scene):
+    """face size of each level, halved like while tiling"""
+
+    sizes = {}
+    size = scene.cubeResolution
+    for level in range(scene.maxLevel, 0, -1):
+        sizes[level] = size
+        size = int(size / 2)
+    return sizes
+
+
+class LazyTiles:
+    """The tiles of some scenes, rendered on first request.
+
+    Encoded tiles are kept in an in-memory LRU cache of ``cache_bytes``. With
+    ``disk_cache`` they are also written to the tile folder of the scene,
+    where tiles created in advance are served from as well.
+    """
+
+    def __init__(self, scenes, **kwargs):
+
+        self.scenes = dict((scene.scene_id, scene) for scene in scenes)
+        self.cache = LRUCache(kwargs.get('cache_bytes', CACHE_BYTES))
+        self.disk_cache = kwargs.get('disk_cache', False)
+        self.max_sources = kwargs.get('max_sources', MAX_SOURCES)
+        self._encoders = dict((scene.scene_id, Encoder(scene.tile_format, scene.image_quality)) for scene in scenes)
+        self._sources = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._row_locks = [threading.Lock() for i in range(ROW_LOCKS)]
+
+    def _source(self, scene, f=None):
+        """the decoded face f, or the panorama if None"""
+
+        key = (scene.scene_id, f)
+        with self._lock:
+            if key in self._sources:
+                self._sources.move_to_end(key)
+                return self._sources[key]
+        if f:
+            source = Image.open(dict(zip(FACES, scene._face_images()))[f]).convert('RGB')
+        else:
+            if not remap.numpy:
+                raise RuntimeError("numpy is required to render tiles from the panorama")
+            source = remap.numpy.asarray(Image.open(_expand(scene.src)).convert('RGB'))
+        with self._lock:
+            self._sources[key] = source
+            while len(self._sources) > self.max_sources:
+                self._sources.popitem(last=False)
+        return source
+
+    def _strip(self, scene, f, size, first, last):
+        """rows first to last of face f scaled to size"""
+
+        face_image = dict(zip(FACES, scene._face_images()))[f]
+        if os.path.isfile(face_image):
+            face = self._source(scene, f)
+            scale = face.width / size
+            return face.resize([size, last - first], _resize_filter(scene.resize_filter),
+                               box=(0, first * scale, face.width, last * scale))
+        image = self._source(scene)
+        factor = max(1, min(SUPERSAMPLING, int(round(scene.cubeResolution / size))))
+        yaw, pitch = ANGLES[FACES.index(f)]
+        strip = remap.remap_face(image, size * factor, yaw, pitch, scene.hfov, scene._image_shift(),
+                                 scene.interpolation, scene.lookup_tables, (first * factor, last * factor))
+        strip = Image.fromarray(strip, 'RGBA').convert('RGB')
+        if factor > 1:
+            strip = strip.resize([size, last - first], _resize_filter(scene.resize_filter))
+        return strip
+
+    def _render_row(self, scene, level, f, row):
+        """encode the tiles of a row, returns them by name"""
+
+        size = _level_sizes(scene)[level]
+        tile_size = scene.tileResolution
+        first = row * tile_size
+        last = min(first + tile_size, size)
+        strip = self._strip(scene, f, size, first, last)
+        encoder = self._encoders[scene.scene_id]
+        tiles = {}
+        for j in range(0, int(math.ceil(size / tile_size))):
+            left = j * tile_size
+            tile = strip.crop([left, 0, min(left + tile_size, size), last - first])
+            tiles["%s/%s%s_%s.%s" % (level, f, row, j, encoder.extension)] = encoder.encode(tile)
+        logger.info("rendered %s level %s row %s of face %s", scene.scene_id, level, row, f)
+        return tiles
+
+    def _render_fallback(self, scene, f):
+        size = min(scene.cubeResolution, FALLBACK_SIZE * SUPERSAMPLING)
+        face = self._strip(scene, f, size, 0, size).resize([FALLBACK_SIZE, FALLBACK_SIZE], _resize_filter(scene.resize_filter))
+        encoder = self._encoders[scene.scene_id]
+        return {"fallback/%s.%s" % (f, encoder.extension): encoder.encode(face)}
+
+    def _render(self, scene, name):
+        """render the tiles needed for name, None if there is no such tile"""
+
+        extension = self._encoders[scene.scene_id].extension
+        match = TILE.match(name)
+        if match:
+            level, f, row, column, ext = match.groups()
+            level, row, column = int(level), int(row), int(column)
+            if ext != extension or not 1 <= level <= scene.maxLevel:
+                return None
+            tiles = int(math.ceil(_level_sizes(scene)[level] / scene.tileResolution))
+            if row >= tiles or column >= tiles:
+                return None
+            return self._render_row(scene, level, f, row)
+        match = FALLBACK.match(name)
+        if match and match.group(2) == extension:
+            return self._render_fallback(scene, match.group(1))
+        return None
+
+    def _row_lock(self, scene_id, name):
+        # one thread renders a row, the others wait for it
+        key = (scene_id, name.rsplit('_', 1)[0])
+        return self._row_locks[hash(key) % ROW_LOCKS]
+
+    def get(self, scene_id, name):
+        """return the encoded tile name of a scene, None if there is none"""
+
+        scene = self.scenes.get(scene_id)
+        if scene is None or not (TILE.match(name) or FALLBACK.match(name)):
+            return None
+        key = (scene_id, name)
+        data = self.cache.get(key)
+        if data is not None:
+            return data
+        with self._row_lock(scene_id, name):
+            data = self.cache.get(key)
+            if data is not None:
+                return data
+            filename = os.path.join(scene.tile_folder, *name.split('/'))
+            if self.disk_cache and os.path.isfile(filename):
+                with open(filename, 'rb') as f:
+                    data = f.read()
+                self.cache.put(key, data)
+                return data
+            tiles = self._render(scene, name)
+            if tiles is None:
+                return None
+            for tile_name, tile in tiles.items():
+                self.cache.put((scene_id, tile_name), tile)
+                if self.disk_cache:
+                    self._write(os.path.join(scene.tile_folder, *tile_name.split('/')), tile)
+            return tiles[name]
+
+    def _write(self, filename, data):
+        _get_or_create_path(os.path.dirname(filename))
+        tmp_name = "%s.%s.tmp" % (filename, threading.get_ident())
+        with open(tmp_name, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_name, filename)
+
+
+class LazyHandler(http.server.BaseHTTPRequestHandler):
+    """Answers tile requests from LazyTiles"""
+
+    def __init__(self, *args, tiles=None, **kwargs):
+        self.tiles = tiles
+        super().__init__(*args, **kwargs)
+
+    def do_GET(self):
+        path = self.path.split('?', 1)[0].strip('/')
+        scene_id, _, name = path.partition('/')
+        data = self.tiles.get(scene_id, name) if name else None
+        if data is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPES.get(name.rsplit('.', 1)[-1], 'application/octet-stream'))
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def server(scenes, port=8000, bind='127.0.0.1', **kwargs):
+    """return a threading HTTP server rendering the tiles of scenes, see LazyTiles"""
+
+    handler = functools.partial(LazyHandler, tiles=LazyTiles(scenes, **kwargs))
+    return http.server.ThreadingHTTPServer((bind, port), handler)
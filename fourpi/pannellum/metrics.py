@@ -0,0 +1,170 @@
+#!/usr/bin/env  python
+# -*- coding: utf-8 -*-
+"""Timings and counters of the stages of a build.
+
+The module level ``metrics`` collects the wall and CPU time of every stage,
+e.g. ``exif.exiftool``, ``extract.nona`` or ``encode``, and counters
+like the tiles and fallback images written and the bytes they take where
+they are stored. Stages running in several threads add up, so their
+wall time may exceed the elapsed time. Worker processes send what they
+measured back with ``snapshot`` to be ``merge``d.
+
+The CPU time of a stage is that of the calling thread, or with
+``process=True`` that of the whole process and of the child processes
+finished meanwhile, e.g. nona or a pool of workers. The latter includes
+whatever other threads did at the same time.
+"""
+
+import contextlib
+import functools
+import json
+import os
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+PROMETHEUS_PREFIX = 'pannellum'
+
+
+def _max_rss(who):
+    """peak resident memory in bytes, None if unknown"""
+
+    if not resource:
+        return None
+    rss = resource.getrusage(who).ru_maxrss
+    # kilobytes everywhere but on macOS
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def _process_cpu():
+    """CPU time of all threads, and of the child processes waited for"""
+
+    if not resource:
+        return time.process_time()
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time() + children.ru_utime + children.ru_stime
+
+
+class Metrics:
+
+    def __init__(self):
+
+        self._lock = threading.Lock()
+        self.reset()
+        if hasattr(os, 'register_at_fork'):
+            # a forked worker may inherit the lock held by another thread
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+
+    def reset(self):
+        with self._lock:
+            self.stages = {}
+            self.counters = {}
+            self.started = time.time()
+
+    @contextlib.contextmanager
+    def stage(self, name, process=False):
+        """measure the wall and CPU time of the enclosed block"""
+
+        clock = _process_cpu if process else time.thread_time
+        wall = time.perf_counter()
+        cpu = clock()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - wall, clock() - cpu)
+
+    def timed(self, name, process=False):
+        """decorator measuring every call as the stage name"""
+
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.stage(name, process):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def add(self, name, wall, cpu=0.0, calls=1):
+        with self._lock:
+            stage = self.stages.setdefault(name, {'calls': 0, 'wall': 0.0, 'cpu': 0.0})
+            stage['calls'] += calls
+            stage['wall'] += wall
+            stage['cpu'] += cpu
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def snapshot(self):
+        """the stages and counters as plain data, e.g. to send from a worker process"""
+
+        with self._lock:
+            return {'stages': dict((name, dict(stage)) for name, stage in self.stages.items()),
+                    'counters': dict(self.counters)}
+
+    def merge(self, snapshot):
+        for name, stage in snapshot['stages'].items():
+            self.add(name, stage['wall'], stage['cpu'], stage['calls'])
+        for name, value in snapshot['counters'].items():
+            self.count(name, value)
+
+    def report(self):
+        report = self.snapshot()
+        report['elapsed'] = time.time() - self.started
+        report['peak_rss'] = _max_rss(resource and resource.RUSAGE_SELF)
+        # the largest of nona, exiftool and the worker processes
+        report['peak_rss_children'] = _max_rss(resource and resource.RUSAGE_CHILDREN)
+        return report
+
+    def write_json(self, path):
+        _write(path, json.dumps(self.report(), sort_keys=True, indent=4))
+
+    def prometheus(self):
+        """the report in the text format of the Prometheus node exporter"""
+
+        report = self.report()
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            name = '%s_%s' % (PROMETHEUS_PREFIX, name)
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for labels, value in samples:
+                lines.append('%s%s %s' % (name, labels, repr(float(value)) if isinstance(value, float) else value))
+
+        stages = sorted(report['stages'].items())
+        metric('stage_seconds_total', 'counter', 'Wall time of a stage, summed over threads.',
+               [('{stage="%s"}' % name, stage['wall']) for name, stage in stages])
+        metric('stage_cpu_seconds_total', 'counter', 'CPU time of a stage.',
+               [('{stage="%s"}' % name, stage['cpu']) for name, stage in stages])
+        metric('stage_calls_total', 'counter', 'Number of times a stage ran.',
+               [('{stage="%s"}' % name, stage['calls']) for name, stage in stages])
+        for name, value in sorted(report['counters'].items()):
+            metric('%s_total' % name, 'counter', 'Counter %s.' % name, [('', value)])
+        metric('elapsed_seconds', 'gauge', 'Wall time since the metrics were reset.', [('', report['elapsed'])])
+        if report['peak_rss'] is not None:
+            metric('peak_rss_bytes', 'gauge', 'Peak resident memory.',
+                   [('{process="self"}', report['peak_rss']), ('{process="children"}', report['peak_rss_children'])])
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        _write(path, self.prometheus())
+
+
+def _write(path, text):
+    # atomically, as the textfile collector may read at any time
+    tmp_name = "%s.%s.tmp" % (path, os.getpid())
+    with open(tmp_name, 'w') as f:
+        f.write(text)
+    os.replace(tmp_name, path)
+
+
+metrics = Metrics()
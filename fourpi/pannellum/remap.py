@@ -0,0 +1,259 @@
+#!/usr/bin/env  python
+# -*- coding: utf-8 -*-
+"""Remap equirectangular panoramas to cubic faces with NumPy.
+
+A replacement for hugins nona, using the same conventions as the script
+written by ``Scene._make_script``: rectilinear faces with a field of view
+of 90 degree, the input rotated by the ``(yaw, pitch)`` of each face and
+shifted vertically by ``e`` pixels for cropped panoramas. Cylindrical
+panoramas, as written by ``eq2cyl``, are remapped the same way.
+"""
+
+import glob
+import logging
+import math
+import os
+import tempfile
+import threading
+
+from fourpi.pannellum.utils import _expand, _get_or_create_path, numpy
+
+logger = logging.getLogger('pannellum.remap')
+
+if not numpy:
+    logger.info("numpy not found, remapping requires nona.")
+
+INTERPOLATIONS = ('nearest', 'bilinear', 'bicubic')
+DEFAULT_INTERPOLATION = 'bicubic'
+
+# upper limit for the lookup tables kept on disk, in bytes
+MAX_LUT_BYTES = 4 * 1024 ** 3
+# rows of a lookup table computed at once
+LUT_ROWS = 256
+
+
+def face_coordinates(size, yaw, pitch, width, height, hfov=360, shift=0, rows=None):
+    """Return the source pixel coordinates of a face.
+
+    ``yaw`` and ``pitch`` are the angles of the input image as written to the
+    nona script, ``shift`` is its vertical offset in pixels. The result are two
+    float32 arrays of shape ``(size, size)`` holding x and y in the
+    equirectangular image, or only the ``rows=(first, last)`` of the face.
+    """
+
+    f = 0.5 * size
+    grid = numpy.arange(size, dtype=numpy.float64) + 0.5 - f
+    if rows:
+        x, y = numpy.meshgrid(grid, grid[rows[0]:rows[1]])
+    else:
+        x, y = numpy.meshgrid(grid, grid)
+    z = numpy.full_like(x, f)
+    y = -y
+
+    # looking at the face means turning the camera the opposite way
+    theta = math.radians(-pitch)
+    psi = math.radians(-yaw)
+    y, z = y * math.cos(theta) + z * math.sin(theta), z * math.cos(theta) - y * math.sin(theta)
+    x, z = x * math.cos(psi) + z * math.sin(psi), z * math.cos(psi) - x * math.sin(psi)
+
+    lng = numpy.arctan2(x, z)
+    lat = numpy.arctan2(y, numpy.hypot(x, z))
+    scale = width / math.radians(hfov)
+    src_x = 0.5 * width + lng * scale - 0.5
+    src_y = 0.5 * height + shift - lat * scale - 0.5
+    return src_x.astype(numpy.float32), src_y.astype(numpy.float32)
+
+
+def cylinder_coordinates(cyl_width, cyl_height, width, height, rows=None):
+    """Return the source pixel coordinates of a cylindrical panorama.
+
+    The cylinder covers 360 degree in ``cyl_width`` pixels, the
+    equirectangular image of ``width`` and ``height`` the whole sphere. Like
+    ``face_coordinates``, the result are x and y of shape
+    ``(cyl_height, cyl_width)``, or only the ``rows=(first, last)``.
+    """
+
+    radius = cyl_width / (2 * math.pi)
+    x = numpy.arange(cyl_width, dtype=numpy.float64) + 0.5 - 0.5 * cyl_width
+    y = numpy.arange(cyl_height, dtype=numpy.float64) + 0.5 - 0.5 * cyl_height
+    if rows:
+        y = y[rows[0]:rows[1]]
+    lng = x / radius
+    lat = numpy.arctan(-y / radius)
+    scale = width / (2 * math.pi)
+    src_x, src_y = numpy.meshgrid(0.5 * width + lng * scale - 0.5, 0.5 * height - lat * scale - 0.5)
+    return src_x.astype(numpy.float32), src_y.astype(numpy.float32)
+
+
+def _cubic_weights(t):
+    """Keys cubic convolution weights (a=-0.5) for the offsets -1, 0, 1, 2"""
+
+    t2 = t * t
+    t3 = t2 * t
+    return (-0.5 * t3 + t2 - 0.5 * t,
+            1.5 * t3 - 2.5 * t2 + 1,
+            -1.5 * t3 + 2 * t2 + 0.5 * t,
+            0.5 * t3 - 0.5 * t2)
+
+
+def sample(image, x, y, interpolation=DEFAULT_INTERPOLATION, wrap=True):
+    """Sample an RGB image array at the float coordinates x, y.
+
+    Returns an RGBA array, pixels outside of the image are transparent.
+    Horizontal coordinates wrap around for full 360 degree panoramas.
+    """
+
+    height, width = image.shape[:2]
+    if wrap:
+        x = numpy.mod(x + 0.5, width) - 0.5
+        inside = (y >= -0.5) & (y <= height - 0.5)
+    else:
+        inside = (x >= -0.5) & (x <= width - 0.5) & (y >= -0.5) & (y <= height - 0.5)
+
+    def columns(i):
+        if wrap:
+            return numpy.mod(i, width)
+        return numpy.clip(i, 0, width - 1)
+
+    def rows(i):
+        return numpy.clip(i, 0, height - 1)
+
+    if interpolation == 'nearest':
+        rgb = image[rows(numpy.rint(y).astype(numpy.intp)), columns(numpy.rint(x).astype(numpy.intp))]
+    else:
+        x0 = numpy.floor(x)
+        y0 = numpy.floor(y)
+        tx = (x - x0)[..., None]
+        ty = (y - y0)[..., None]
+        x0 = x0.astype(numpy.intp)
+        y0 = y0.astype(numpy.intp)
+        if interpolation == 'bilinear':
+            wx = (1 - tx, tx)
+            wy = (1 - ty, ty)
+            offsets = (0, 1)
+        elif interpolation == 'bicubic':
+            wx = _cubic_weights(tx)
+            wy = _cubic_weights(ty)
+            offsets = (-1, 0, 1, 2)
+        else:
+            raise ValueError("unknown interpolation %s" % interpolation)
+        rgb = numpy.zeros(x.shape + (3,), dtype=numpy.float32)
+        for m, dy in enumerate(offsets):
+            r = rows(y0 + dy)
+            row = numpy.zeros_like(rgb)
+            for n, dx in enumerate(offsets):
+                row += wx[n] * image[r, columns(x0 + dx)]
+            rgb += wy[m] * row
+        rgb = numpy.clip(numpy.rint(rgb), 0, 255).astype(numpy.uint8)
+
+    rgb[~inside] = 0
+    alpha = numpy.where(inside, 255, 0).astype(numpy.uint8)
+    return numpy.dstack((rgb, alpha))
+
+
+class LookupTables:
+    """Disk cache for the results of ``face_coordinates``.
+
+    Panoramas of the same geometry share their source coordinates, which are
+    stored as ``.npy`` files and memory mapped on reuse. The least recently
+    used tables are removed once the folder grows beyond ``max_bytes``.
+    Threads may share one instance, a table is computed by one of them.
+    """
+
+    def __init__(self, folder, max_bytes=MAX_LUT_BYTES):
+
+        self.folder = _get_or_create_path(_expand(folder))
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        # guards the counters and the files, a table is only removed under it
+        self._lock = threading.Lock()
+        # a table computed by one thread is waited for by the others
+        self._creating = {}
+
+    def _path(self, size, yaw, pitch, width, height, hfov, shift):
+        name = "lut-%sx%s-%s-v%g-e%g-y%g-p%g.npy" % (width, height, size, hfov, shift, yaw, pitch)
+        return os.path.join(self.folder, name)
+
+    def _load(self, path):
+        with self._lock:
+            if not os.path.isfile(path):
+                return None
+            os.utime(path)
+            self.hits += 1
+            return numpy.load(path, mmap_mode='r')
+
+    def _create(self, path, size, yaw, pitch, width, height, hfov, shift):
+        # computed in chunks of rows straight into a file of its own
+        fd, tmp_name = tempfile.mkstemp('.tmp', os.path.basename(path), dir=self.folder)
+        os.close(fd)
+        try:
+            tables = numpy.lib.format.open_memmap(tmp_name, mode='w+', dtype=numpy.float32, shape=(2, size, size))
+            for first in range(0, size, LUT_ROWS):
+                last = min(first + LUT_ROWS, size)
+                tables[:, first:last] = face_coordinates(size, yaw, pitch, width, height, hfov, shift, (first, last))
+            tables.flush()
+            del tables
+            os.replace(tmp_name, path)
+        finally:
+            if os.path.exists(tmp_name):
+                os.remove(tmp_name)
+        logger.info("lookup table %s created", path)
+
+    def get(self, size, yaw, pitch, width, height, hfov=360, shift=0, rows=None):
+        """return x and y like face_coordinates, computing them only once"""
+
+        path = self._path(size, yaw, pitch, width, height, hfov, shift)
+        tables = self._load(path)
+        if tables is None:
+            with self._lock:
+                creating = self._creating.setdefault(path, threading.Lock())
+            try:
+                with creating:
+                    # made by another thread meanwhile
+                    tables = self._load(path)
+                    if tables is None:
+                        self._create(path, size, yaw, pitch, width, height, hfov, shift)
+                        with self._lock:
+                            self.misses += 1
+                            self._evict(keep=path)
+                            tables = numpy.load(path, mmap_mode='r')
+            finally:
+                with self._lock:
+                    self._creating.pop(path, None)
+        if rows:
+            return tables[0, rows[0]:rows[1]], tables[1, rows[0]:rows[1]]
+        return tables[0], tables[1]
+
+    def evict(self, keep=None):
+        """remove the least recently used tables above max_bytes"""
+
+        with self._lock:
+            self._evict(keep)
+
+    def _evict(self, keep=None):
+        tables = sorted(glob.glob(os.path.join(self.folder, 'lut-*.npy')), key=os.path.getmtime)
+        total = sum(os.path.getsize(table) for table in tables)
+        for table in tables:
+            if total <= self.max_bytes:
+                break
+            if table == keep:
+                continue
+            total -= os.path.getsize(table)
+            os.remove(table)
+            logger.info("lookup table %s removed", table)
+
+
+def remap_face(image, size, yaw, pitch, hfov=360, shift=0, interpolation=DEFAULT_INTERPOLATION, tables=None, rows=None):
+    """Return the RGBA face looking at (yaw, pitch) of an equirectangular image array.
+
+    ``tables`` is an optional LookupTables instance to reuse the coordinates,
+    ``rows=(first, last)`` restricts the result to a horizontal strip.
+    """
+
+    height, width = image.shape[:2]
+    if tables:
+        x, y = tables.get(size, yaw, pitch, width, height, hfov, shift, rows)
+    else:
+        x, y = face_coordinates(size, yaw, pitch, width, height, hfov, shift, rows)
+    return sample(image, x, y, interpolation, wrap=hfov >= 360)
@@ -1,44 +1,311 @@
 #!/usr/bin/env  python
 
-from distutils.spawn import find_executable
+import concurrent.futures
 import logging
 import math
 import subprocess
 import os
 import json
+import hashlib
+import shutil
 import tempfile
 
-import PIL.Image
-
 from fourpi.pannellum.hotspot import HotSpot
+from fourpi.pannellum.encoder import Encoder
+from fourpi.pannellum.dedup import Deduplicator
+from fourpi.pannellum.metrics import metrics
 from fourpi.pannellum.exif import Exif
-from fourpi.pannellum.utils import _expand, _scene_id_from_image, _get_or_create_path
+from fourpi.pannellum import remap, tuner
+from fourpi.pannellum.spatial import neighbours
+from fourpi.pannellum.utils import _digest, _expand, _scene_id_from_image, _get_or_create_path, find_tool, Image
 
 MAXIMUM_TILESIZE = 640
 MAXIMUM_LEVELS = 6
-EXTENSION = "jpg"
+MANIFEST = "manifest.json"
+FALLBACK_SIZE = 1024
 
 FACES = ["f", "b", "l", "r", "u", "d"]
 ANGLES = [(0, 0), (-180, 0), (90, 0), (-90, 0), (0, -90), (0, 90)]
 
+# name: Pillow filter, looked up once an image is resized
 RESIZE_FILTERS = {
-    'cubic': PIL.Image.CUBIC,
-    'bilinear': PIL.Image.BILINEAR,
-    'bicubic': PIL.Image.BICUBIC,
-    'nearest': PIL.Image.NEAREST,
-    'antialias': PIL.Image.ANTIALIAS,
+    'cubic': 'CUBIC',
+    'bilinear': 'BILINEAR',
+    'bicubic': 'BICUBIC',
+    'nearest': 'NEAREST',
+    # the same filter, without the deprecation warning of ANTIALIAS
+    'antialias': 'LANCZOS',
 }
 
-DEFAULT_RESIZE_FILTER = PIL.Image.ANTIALIAS
+DEFAULT_RESIZE_FILTER = 'antialias'
 DEFAULT_IMAGE_FORMAT = 'jpg'
 DEFAULT_IMAGE_QUALITY = 0.8
 
+REMAPPERS = ('nona', 'numpy')
+DEFAULT_REMAPPER = 'nona'
+
 logger = logging.getLogger('pannellum.scene')
 
-NONA = find_executable('nona')
 
-if not NONA:
-    logger.error("nona required but not found.")
+def _save_tile(face, box, filename, encoder):
+    tile = face.crop(box)
+    tile.load()
+    encoder.save(tile, filename)
+    metrics.count('tiles')
+
+
+def _level_dir(tile_folder, level, encoder):
+    """the folder of the tiles of a level or the fallback images, only made if they are files"""
+
+    level_dir = os.path.join(tile_folder, str(level))
+    return _get_or_create_path(level_dir) if encoder.writes_files else level_dir
+
+
+def _fallback_level(size, levels):
+    """The smallest level at least FALLBACK_SIZE wide, the top level if none is"""
+
+    level = levels
+    while level > 1 and int(size / 2) >= FALLBACK_SIZE:
+        size = int(size / 2)
+        level = level - 1
+    return level
+
+
+def _resize_filter(resize_filter):
+    """the Pillow filter of a name of RESIZE_FILTERS, other filters as they are"""
+
+    if resize_filter in RESIZE_FILTERS:
+        return getattr(Image, RESIZE_FILTERS[resize_filter])
+    return resize_filter
+
+
+def _save_fallback(face, filename, encoder, resize_filter=DEFAULT_RESIZE_FILTER):
+    with metrics.stage('resize'):
+        face = face.resize([FALLBACK_SIZE, FALLBACK_SIZE], _resize_filter(resize_filter))
+    encoder.save(face, filename)
+    metrics.count('fallbacks')
+
+
+def _tile_face(f, image, size, levels, tile_size, tile_folder, encoder, threads=1, fallback=None,
+               resize_filter=DEFAULT_RESIZE_FILTER):
+    """Cut one cubic face into the tiles of all levels.
+
+    Runs in a worker process when tiling in parallel, the tiles of a level
+    are encoded by ``threads`` threads, as Pillow releases the GIL meanwhile.
+    If ``fallback`` is given, the face is also scaled down to that file,
+    starting from the smallest level which is large enough.
+    """
+
+    logger.info("tiling face %s", f)
+    fallback_level = _fallback_level(size, levels)
+    face = image if isinstance(image, Image.Image) else Image.open(image)
+    # decoded once here, the threads cropping a lazily opened image would each load it
+    face.load()
+    if face.mode == 'RGBA':
+        face = face.convert('RGB')
+    with concurrent.futures.ThreadPoolExecutor(threads) as pool:
+        for level in range(levels, 0, -1):
+            level_dir = _level_dir(tile_folder, level, encoder)
+            tiles = int(math.ceil(size / tile_size))
+            if level < levels:
+                with metrics.stage('resize'):
+                    face = face.resize([size, size], _resize_filter(resize_filter))
+            futures = []
+            if fallback and level == fallback_level:
+                futures.append(pool.submit(_save_fallback, face, fallback, encoder, resize_filter))
+            for i in range(0, tiles):
+                for j in range(0, tiles):
+                    left = j * tile_size
+                    upper = i * tile_size
+                    right = min(j * tile_size + tile_size, size)
+                    lower = min(i * tile_size + tile_size, size)
+                    filename = os.path.join(level_dir, "%s%s_%s.%s" % (f, i, j, encoder.extension))
+                    futures.append(pool.submit(_save_tile, face, [left, upper, right, lower], filename, encoder))
+            for future in futures:
+                future.result()
+            encoder.sync()
+            size = int(size / 2)
+
+
+def _tile_face_measured(*job):
+    """_tile_face in a worker process, returning what it measured"""
+
+    metrics.reset()
+    _tile_face(*job)
+    return metrics.snapshot()
+
+
+def _append_rows(rows, strip):
+    if rows is None:
+        return strip
+    joined = Image.new(rows.mode, (rows.width, rows.height + strip.height))
+    joined.paste(rows, (0, 0))
+    joined.paste(strip, (0, rows.height))
+    return joined
+
+
+class _Tiler:
+    """Cuts the rows of one level, arriving top down, into tiles.
+
+    Only the current row of tiles is held, plus the rows still being encoded.
+    """
+
+    def __init__(self, f, level, size, tile_size, tile_folder, encoder, pool):
+
+        self.f = f
+        self.size = size
+        self.tile_size = tile_size
+        self.encoder = encoder
+        self.pool = pool
+        self.level_dir = _level_dir(tile_folder, level, encoder)
+        self.rows = None
+        self.row = 0
+        self.received = 0
+        self.futures = []
+
+    def add(self, strip):
+        self.rows = _append_rows(self.rows, strip)
+        self.received += strip.height
+        while self.rows is not None and (self.rows.height >= self.tile_size or self.received == self.size):
+            self._write_row(min(self.tile_size, self.rows.height))
+
+    def _write_row(self, height):
+        # wait for the previous row, so finished rows can be freed
+        for future in self.futures:
+            future.result()
+        self.futures = []
+        for j in range(0, int(math.ceil(self.size / self.tile_size))):
+            left = j * self.tile_size
+            right = min(left + self.tile_size, self.size)
+            filename = os.path.join(self.level_dir, "%s%s_%s.%s" % (self.f, self.row, j, self.encoder.extension))
+            self.futures.append(self.pool.submit(_save_tile, self.rows, [left, 0, right, height], filename, self.encoder))
+        self.row += 1
+        if height == self.rows.height:
+            self.rows = None
+        else:
+            self.rows = self.rows.crop([0, height, self.size, self.rows.height])
+
+    def close(self):
+        for future in self.futures:
+            future.result()
+
+
+class _Resizer:
+    """Resizes a square image whose rows arrive top down.
+
+    The resized rows are passed on as soon as the antialias filter has seen
+    all of their input rows. Pillow computes the filter relative to the
+    ``box`` of the full image, so the result matches resizing it at once.
+    """
+
+    def __init__(self, size, new_size, sinks, resize_filter=DEFAULT_RESIZE_FILTER):
+
+        self.size = size
+        self.new_size = new_size
+        self.sinks = sinks
+        self.resize_filter = resize_filter
+        self.scale = size / new_size
+        # no filter reaches further than lanczos, 3 input pixels scaled when downsizing
+        self.margin = int(math.ceil(3 * max(self.scale, 1))) + 2
+        self.rows = None
+        self.first = 0
+        self.received = 0
+        self.done = 0
+
+    def add(self, strip):
+        self.rows = _append_rows(self.rows, strip)
+        self.received += strip.height
+        if self.received >= self.size:
+            end = self.new_size
+        else:
+            end = min(int((self.received - self.margin) / self.scale), self.new_size)
+        if end <= self.done:
+            return
+        box = (0, self.done * self.scale - self.first, self.size, end * self.scale - self.first)
+        with metrics.stage('resize'):
+            resized = self.rows.resize([self.new_size, end - self.done], _resize_filter(self.resize_filter), box=box)
+        self.done = end
+        first = int(math.floor(self.done * self.scale)) - self.margin
+        if first > self.first:
+            self.rows = self.rows.crop([0, first - self.first, self.size, self.rows.height])
+            self.first = first
+        for sink in self.sinks:
+            sink.add(resized)
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+
+class _Collector:
+    """Assembles the rows of a small image and saves it once complete."""
+
+    def __init__(self, size, filename, encoder):
+
+        self.image = Image.new('RGB', (size, size))
+        self.filename = filename
+        self.encoder = encoder
+        self.received = 0
+
+    def add(self, strip):
+        self.image.paste(strip, (0, self.received))
+        self.received += strip.height
+
+    def close(self):
+        self.encoder.save(self.image, self.filename)
+        metrics.count('fallbacks')
+
+
+def _tile_face_strips(f, strips, size, levels, tile_size, tile_folder, encoder, threads=1, fallback=None,
+                      resize_filter=DEFAULT_RESIZE_FILTER):
+    """Cut one cubic face, given as horizontal strips, into the tiles of all levels.
+
+    Every level only keeps about one row of tiles in memory. If ``fallback``
+    is given, the face is also scaled down and saved to that file, like in
+    ``_tile_face``.
+    """
+
+    logger.info("tiling face %s in strips", f)
+    fallback_level = _fallback_level(size, levels)
+    with concurrent.futures.ThreadPoolExecutor(threads) as pool:
+
+        def chain(level, size):
+            sinks = [_Tiler(f, level, size, tile_size, tile_folder, encoder, pool)]
+            if level > 1:
+                sinks.append(_Resizer(size, int(size / 2), chain(level - 1, int(size / 2)), resize_filter))
+            if fallback and level == fallback_level:
+                sinks.append(_Resizer(size, FALLBACK_SIZE, [_Collector(FALLBACK_SIZE, fallback, encoder)], resize_filter))
+            return sinks
+
+        sinks = chain(levels, size)
+        for strip in strips:
+            if strip.mode != 'RGB':
+                strip = strip.convert('RGB')
+            for sink in sinks:
+                sink.add(strip)
+        for sink in sinks:
+            sink.close()
+    encoder.sync()
+
+
+def _file_strips(image, height):
+    """Horizontal strips of an image or image file"""
+
+    face = image if isinstance(image, Image.Image) else Image.open(image)
+    for upper in range(0, face.height, height):
+        yield face.crop([0, upper, face.width, min(upper + height, face.height)])
+
+
+def _json_key(value):
+    return json.dumps(value, sort_keys=True, default=str)
+
+
+def linked_digest(exifdata):
+    """digest of what the hotspots show of every scene, for scenes linking to all others"""
+
+    linked = [(scene_id, exif.get('title', 'n/a'), exif.get('latlng', None), exif.get('northOffset', 0))
+              for scene_id, exif in sorted(exifdata.items())]
+    return hashlib.sha1(_json_key(linked).encode('utf-8')).hexdigest()
 
 
 class Scene:
@@ -49,19 +316,20 @@ class Scene:
 
     def __init__(self, panorama, exifdata=None, **kwargs):
 
-        conf = {}
         self.src = panorama
-        if not exifdata:
-            exifdata = {}
-        self.exifdata = exifdata
         self.scene_id = _scene_id_from_image(panorama)
         dest = _expand(os.path.dirname(self.src))
         self.output_dir = os.path.join(dest, self.scene_id)
         image_quality = kwargs.get('image_quality', DEFAULT_IMAGE_QUALITY)
         self.image_quality = int(image_quality * 100)
-        autoRotate = kwargs.get('autoRotate', None)
-        if autoRotate:
-            conf['autoRotate'] = autoRotate
+        self.tile_format = kwargs.get('tile_format', DEFAULT_IMAGE_FORMAT)
+        self.encoder = Encoder(self.tile_format, self.image_quality)
+        # the archive stores every tile content once anyway
+        self.archive = kwargs.get('archive', False)
+        self.dedup = None if self.archive else kwargs.get('dedup', None)
+        # a name of RESIZE_FILTERS or a Pillow filter
+        self.resize_filter = kwargs.get('resize_filter', DEFAULT_RESIZE_FILTER)
+        self.autoRotate = kwargs.get('autoRotate', None)
         basePath = kwargs.get('basePath', None)
         if basePath:
             self.basePath = '/'.join((basePath, self.scene_id))
@@ -69,11 +337,67 @@ class Scene:
             self.basePath = None
         #    self.basePath = self.scene_id
         self.hfov = kwargs.get('hfov', 360)
+        self.remapper = kwargs.get('remapper', DEFAULT_REMAPPER)
+        self.interpolation = kwargs.get('interpolation', remap.DEFAULT_INTERPOLATION)
+        self.lookup_tables = kwargs.get('lookup_tables', None)
+        self.workers = kwargs.get('workers', 1)
+        self.threads = kwargs.get('threads', 1)
+        self.low_memory = kwargs.get('low_memory', False)
+        self.keep_faces = kwargs.get('keep_faces', False)
         self.tile_size = kwargs.get('tile_size', None)
+        # choose face and tile size with the cost model of the tuner
+        self.tune = kwargs.get('tune', False)
+        self.tuning = None
         tile_folder = kwargs.get('tile_folder', '')
         self.tile_folder = os.path.join(tile_folder, self.scene_id)
+        if self.archive:
+            # imported here, the archive module brings the http server along
+            from fourpi.pannellum.archive import ArchiveWriter
+            self.encoder = ArchiveWriter(self.encoder, self.tile_folder)
+        elif self.dedup:
+            self.encoder = Deduplicator(self.encoder, self.dedup)
         self.filename = os.path.split(panorama)[1]
+        self.max_hotspots = kwargs.get('max_hotspots', None)
+        self.max_distance = kwargs.get('max_distance', None)
+        self.conf_cache = kwargs.get('conf_cache', None)
+        # linked_digest of the exifdata, made once by the tour for all its scenes
+        self.linked_digest = kwargs.get('linked_digest', None)
+        self.exifdata = exifdata
+        self.spatial_index = kwargs.get('spatial_index', None)
+        # computed for many scenes at once by the tour
+        self.hotspots = kwargs.get('hotspots', None)
+        self.faces = []
+        self.fallbacks = []
+
+    @property
+    def exifdata(self):
+        return self._exifdata
+
+    @exifdata.setter
+    def exifdata(self, exifdata):
+        self._exifdata = exifdata or {}
+        self.spatial_index = None
+        self.hotspots = None
+        self._read_exif()
+
+    def forget(self):
+        """drop the configuration and its hotspots, made again or taken from the conf_cache if needed"""
+
+        self._conf = None
+        self._conf_linked = None
+        self._cache_missed = False
+        self._neighbour_ids = None
+        self.hotspots = None
+
+    def _read_exif(self):
+        """take the values of the scene from the exif data, forgetting the configuration"""
+
+        self._conf = None
+        self._conf_linked = None
+        self._cache_missed = False
+        self._neighbour_ids = None
         self.exif = self.exifdata.get(self.scene_id, {})
+        self._exif_key = _json_key(self.exif)
         self.width = self.exif.get('width', 0)
         self.height = self.exif.get('height', 0)
         self.title = self.exif.get('title', 'n/a')
@@ -90,6 +414,74 @@ class Scene:
         self.croppedTop = self.exif.get('croppedTop', 0)
         logger.info("gpano: %s %s %s " % (self.panoHeight, self.croppedHeight, self.croppedTop))
 
+    @property
+    def conf(self):
+        """The configuration of the scene.
+
+        Made on first use, or taken from the ``conf_cache`` if the scene did
+        not change since, and made again once its exif data or the scenes it
+        links to changed.
+        """
+
+        if not self.cached():
+            with metrics.stage('scene.conf'):
+                self._conf = self._make_conf()
+            self._conf_linked = self._linked()
+            if self.conf_cache is not None:
+                self.conf_cache.set(self.scene_id, self.fingerprint(), self._conf)
+        return self._conf
+
+    def cached(self):
+        """True if the configuration is known, taking it from the conf_cache"""
+
+        self._check_stale()
+        if self._conf is None and self.conf_cache is not None and not self._cache_missed:
+            self._conf = self.conf_cache.get(self.scene_id, self.fingerprint())
+            self._cache_missed = self._conf is None
+            if self._conf is not None:
+                self._conf_linked = self._linked()
+        return self._conf is not None
+
+    def _linked(self):
+        return self.linked_digest or linked_digest(self.exifdata)
+
+    def _check_stale(self):
+        """forget the configuration if the exif data of this or any other scene changed since it was made"""
+
+        if _json_key(self.exif) != self._exif_key:
+            # changed in place
+            self.hotspots = None
+            self._read_exif()
+        elif self._conf is not None and self._linked() != self._conf_linked:
+            self.forget()
+
+    def fingerprint(self):
+        """digest of everything the configuration depends on"""
+
+        if not (self.max_hotspots or self.max_distance) or not self.exif.get('latlng', None):
+            # linked to all other scenes
+            linked = self._linked()
+        else:
+            linked = []
+            for scene_id in self._neighbours():
+                exif = self.exifdata[scene_id]
+                linked.append((scene_id, exif.get('title', 'n/a'), exif.get('latlng', None),
+                               exif.get('northOffset', 0)))
+        return hashlib.sha1(_json_key({
+            'exif': self.exif,
+            'autoRotate': self.autoRotate,
+            'basePath': self.basePath,
+            'tile_size': self.tile_size,
+            'tune': self.tune,
+            'extension': self.encoder.extension,
+            'linked': linked,
+        }).encode('utf-8')).hexdigest()
+
+    def _make_conf(self):
+        conf = {}
+        if self.autoRotate:
+            conf['autoRotate'] = self.autoRotate
+
         minPitch, maxPitch = self._pitch()
 
         conf['type'] = 'multires'
@@ -107,15 +499,23 @@ class Scene:
         conf['hfov'] = self.exif.get('fov', 0)
 
         conf['multiRes'] = self._multires_conf()
-        hotspots = []
-        for dest_scene_id in list(self.exifdata.keys()):
+        hotspots = self.hotspots
+        if hotspots is None:
+            hotspots = []
             src_scene_id = self.scene_id
-            if src_scene_id != dest_scene_id:
+            for dest_scene_id in self._neighbours():
                 hs = HotSpot(dest_scene_id, self.exifdata[src_scene_id], self.exifdata[dest_scene_id])
                 hotspots.append(hs.get_conf())
         conf['hotSpots'] = hotspots
-        self.conf = conf
-        self.faces = []
+        return conf
+
+    def _neighbours(self):
+        """Return the scenes to link to, see spatial.neighbours"""
+
+        if self._neighbour_ids is None:
+            self._neighbour_ids = neighbours(self.scene_id, self.exifdata, self.max_hotspots, self.max_distance,
+                                             self.spatial_index)
+        return self._neighbour_ids
 
     def _multires_conf(self):
         """Configuration for a multiresolution scene"""
@@ -125,7 +525,7 @@ class Scene:
             conf['basePath'] = self.basePath
         conf['path'] = '/%l/%s%y_%x'
         conf['fallbackPath'] = "/fallback/%s"
-        conf['extension'] = EXTENSION
+        conf['extension'] = self.encoder.extension
         conf['tileResolution'] = self.tileResolution
         conf['maxLevel'] = self.maxLevel
         conf['cubeResolution'] = self.cubeResolution
@@ -162,6 +562,15 @@ class Scene:
                 exp = exp + 1
                 fragments = 2 ** exp
         self.maxLevel = int(math.log(self.cubeResolution / self.tileResolution, 2) + 1)
+        self.tuning = None
+        if self.tune and not tile_size and self.width:
+            self.tuning = tuner.tune(self.width, (self.cubeResolution, self.tileResolution, self.maxLevel))
+            chosen = self.tuning['chosen']
+            self.cubeResolution = chosen['cubeResolution']
+            self.tileResolution = chosen['tileResolution']
+            self.maxLevel = chosen['maxLevel']
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("%s tuned, %s", self.scene_id, tuner.format_report(self.tuning))
         scale = self.cubeResolution / raw_face_width
         logger.info("Scaling: %s, Tile: %s, Face: %s ", scale, self.tileResolution, self.cubeResolution)
         return scale
@@ -171,84 +580,342 @@ class Scene:
         logger.info("shift: %s " % e)
         return e
 
-    def _make_script(self):
-        """Create """
+    def _make_script(self, folder=None):
+        """Create the nona script remapping the panorama to the six faces"""
         vertical_shift = self._image_shift()
-        tmp_fd, tmp_name = tempfile.mkstemp(".txt", "nona")
-        script = os.fdopen(tmp_fd, "w")
-        script.write('p f0 w%s h%s n"TIFF_m" u0 v90\n' % (self.cubeResolution, self.cubeResolution))
-        for yaw, pitch in ANGLES:
-            script.write('i f4 w%s h%s e%s y%s p%s r0 v%s n"%s"\n' % (self.width, self.height, vertical_shift, yaw, pitch, self.hfov, _expand(self.src)))
+        tmp_fd, tmp_name = tempfile.mkstemp(".txt", "nona", dir=folder)
+        with os.fdopen(tmp_fd, "w") as script:
+            script.write('p f0 w%s h%s n"TIFF_m" u0 v90\n' % (self.cubeResolution, self.cubeResolution))
+            for yaw, pitch in ANGLES:
+                script.write('i f4 w%s h%s e%s y%s p%s r0 v%s n"%s"\n' % (self.width, self.height, vertical_shift, yaw, pitch, self.hfov, _expand(self.src)))
         logger.info("Script created at %s", tmp_name)
         return tmp_name
 
+    def _run_nona(self, output):
+        """Remap the panorama with nona to the files output0000.tif to output0005.tif"""
+
+        if not find_tool('nona'):
+            raise RuntimeError("nona required but not found, try the numpy remapper")
+        script = self._make_script(os.path.dirname(output))
+        try:
+            with metrics.stage('extract.nona', process=True):
+                nona = subprocess.Popen((find_tool('nona'), '-v', '-o', output, script), shell=False,
+                                        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                stdout, stderr = nona.communicate()
+            if nona.returncode:
+                raise RuntimeError("nona failed on %s with %s: %s" % (self.src, nona.returncode,
+                                                                     stderr.decode('utf-8', 'replace').strip()))
+        finally:
+            os.remove(script)
+
+    def _face_images(self):
+        return [os.path.join(self.output_dir, "%s%04d.tif" % (self.scene_id, +i)) for i in range(6)]
+
+    @metrics.timed('extract', process=True)
     def extract(self):
         """extract all six cubic faces from the panorama"""
 
-        output = os.path.join(self.output_dir, self.scene_id)
         od = _get_or_create_path(self.output_dir)
         logger.info("Outputdir %s created", od)
-        script = self._make_script()
-        args = (NONA, '-v', '-o', output, script)
-        nona = subprocess.Popen(args, shell=False, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        nona.communicate()
-        faces = [os.path.join(self.output_dir, "%s%04d.tif" % (self.scene_id, +i)) for i in range(6)]
+        faces = self._face_images()
+        # empty faces are not written, do not leave those of an earlier run
+        for image in faces:
+            if os.path.isfile(image):
+                os.remove(image)
+        if self.remapper == 'numpy':
+            self._remap(faces)
+        else:
+            self._run_nona(os.path.join(self.output_dir, self.scene_id))
         self.faces = list(zip(FACES, faces))
 
-    def tile(self, force=False):
-        """check existing output """
+    def _source_array(self):
+        if not remap.numpy:
+            raise RuntimeError("numpy is required for the numpy remapper")
+        return remap.numpy.asarray(Image.open(_expand(self.src)).convert('RGB'))
+
+    def _blank_face(self):
+        logger.info("create blank image %sx%s" % (self.cubeResolution, self.cubeResolution))
+        return Image.new("1", (self.cubeResolution, self.cubeResolution))
+
+    def _extract_faces(self, todo=FACES):
+        """Yield (face, image) of the faces in todo, extracted into memory.
+
+        nona writes its faces to a temporary folder, see ``tempfile``, where
+        each is removed once read. Empty faces become blank images.
+        """
+
+        if self.remapper == 'numpy':
+            image = self._source_array()
+            vertical_shift = self._image_shift()
+            for f, (yaw, pitch) in zip(FACES, ANGLES):
+                if f not in todo:
+                    continue
+                with metrics.stage('extract.remap'):
+                    face = remap.remap_face(image, self.cubeResolution, yaw, pitch, self.hfov,
+                                            vertical_shift, self.interpolation, self.lookup_tables)
+                if face[..., 3].any():
+                    yield f, Image.fromarray(face, 'RGBA').convert('RGB')
+                else:
+                    yield f, self._blank_face()
+            return
+
+        with tempfile.TemporaryDirectory(prefix='nona') as folder:
+            output = os.path.join(folder, self.scene_id)
+            self._run_nona(output)
+            for i, f in enumerate(FACES):
+                if f not in todo:
+                    continue
+                image = "%s%04d.tif" % (output, i)
+                if os.path.isfile(image):
+                    face = Image.open(image)
+                    face.load()
+                    os.remove(image)
+                    yield f, face.convert('RGB') if face.mode == 'RGBA' else face
+                else:
+                    yield f, self._blank_face()
 
-        levels = self.maxLevel
-        tile_size = self.tileResolution
-        exists = os.path.isdir(self.tile_folder)
-        if not exists or force:
-            # _get_or_create_path(self.tile_folder)# os.makedirs(self.output_dir)
+    def _disk_faces(self, manifest, todo):
+        """Return (face, image file) of the faces in todo, extracted to the output folder"""
+
+        self.faces = list(zip(FACES, self._face_images()))
+        if manifest.get('extracted') and all(os.path.isfile(image) for f, image in self.faces):
+            logger.info("Reusing the faces in %s", self.output_dir)
+        else:
             self.extract()
             for f, image in self.faces:
                 if not os.path.isfile(image):
                     logger.info("face %s not found", f)
-                    dummy = PIL.Image.new("1", (self.cubeResolution, self.cubeResolution))
-                    dummy.save(image, 'TIFF')
-                    logger.info("create blank image %sx%s" % (self.cubeResolution, self.cubeResolution))
-                logger.info("tiling face %s", f)
-                size = self.cubeResolution
-                face = PIL.Image.open(image)
-                if face.mode == 'RGBA':
-                    face = face.convert('RGB')
-                for level in range(levels, 0, -1):
-                    level_dir = _get_or_create_path(os.path.join(self.tile_folder, str(level)))
-                    tiles = int(math.ceil(size / tile_size))
-                    if level < levels:
-                        face = face.resize([size, size], PIL.Image.ANTIALIAS)
-                    for i in range(0, tiles):
-                        for j in range(0, tiles):
-                            left = j * tile_size
-                            upper = i * tile_size
-                            right = min(j * tile_size + tile_size, size)
-                            lower = min(i * tile_size + tile_size, size)
-                            tile = face.crop([left, upper, right, lower])
-                            tile.load()
-                            tile.save(os.path.join(level_dir, "%s%s_%s.%s" % (f, i, j, EXTENSION)), 'JPEG', quality=self.image_quality)
-                    size = int(size / 2)
+                    self._blank_face().save(image, 'TIFF')
+            manifest['extracted'] = True
+            self._write_manifest(manifest)
+        return [(f, image) for f, image in self.faces if f in todo]
+
+    def _remap_strips(self, image, yaw, pitch):
+        """Remap a face in horizontal strips of one row of tiles"""
+
+        vertical_shift = self._image_shift()
+        for first in range(0, self.cubeResolution, self.tileResolution):
+            rows = (first, min(first + self.tileResolution, self.cubeResolution))
+            with metrics.stage('extract.remap'):
+                strip = remap.remap_face(image, self.cubeResolution, yaw, pitch, self.hfov,
+                                         vertical_shift, self.interpolation, self.lookup_tables, rows)
+            yield Image.fromarray(strip, 'RGBA')
+
+    def _fallback_image(self, f):
+        fallback_dir = _level_dir(self.tile_folder, 'fallback', self.encoder)
+        return os.path.join(fallback_dir, "%s.%s" % (f, self.encoder.extension))
+
+    def _tile_low_memory(self, manifest, todo):
+        """Remap and tile face by face in strips, without writing the faces."""
+
+        image = self._source_array()
+        for f, (yaw, pitch) in zip(FACES, ANGLES):
+            if f not in todo:
+                continue
+            _tile_face_strips(f, self._remap_strips(image, yaw, pitch), self.cubeResolution, self.maxLevel,
+                              self.tileResolution, self.tile_folder, self.encoder, self.threads,
+                              self._fallback_image(f), self.resize_filter)
+            manifest['faces'].append(f)
+            self._write_manifest(manifest)
+            self.fallbacks.append(f)
+
+    def _remap(self, faces):
+        """Remap the faces in process, without calling nona.
+
+        Like nona, faces without any image content are not written.
+        """
+
+        image = self._source_array()
+        vertical_shift = self._image_shift()
+        for (yaw, pitch), image_name in zip(ANGLES, faces):
+            with metrics.stage('extract.remap'):
+                face = remap.remap_face(image, self.cubeResolution, yaw, pitch, self.hfov,
+                                        vertical_shift, self.interpolation, self.lookup_tables)
+            if not face[..., 3].any():
+                logger.info("face %s is empty", image_name)
+                continue
+            Image.fromarray(face, 'RGBA').save(image_name, 'TIFF')
+            logger.info("face %s remapped", image_name)
+
+    def _source_identity(self, previous=None):
+        """size, mtime and sha1 of the panorama, the hash is reused if unchanged"""
+
+        stat = os.stat(_expand(self.src))
+        identity = {'size': stat.st_size, 'mtime': stat.st_mtime}
+        if previous and previous.get('size') == identity['size'] and previous.get('mtime') == identity['mtime']:
+            identity['sha1'] = previous['sha1']
         else:
-            logger.info("Skipping extraction and tile creation, %s exists", self.tile_folder)
+            identity['sha1'] = _digest(_expand(self.src))
+        return identity
+
+    def _build_params(self):
+        """everything the tiles depend on besides the panorama itself"""
+
+        return {
+            'width': self.width,
+            'height': self.height,
+            'hfov': self.hfov,
+            'shift': self._image_shift(),
+            'remapper': self.remapper,
+            'interpolation': self.interpolation,
+            'cubeResolution': self.cubeResolution,
+            'tileResolution': self.tileResolution,
+            'maxLevel': self.maxLevel,
+            'quality': self.image_quality,
+            'tile_format': self.tile_format,
+            'resize_filter': _resize_filter(self.resize_filter),
+            'dedup': self.dedup,
+            'archive': self.archive,
+        }
+
+    def read_manifest(self):
+        """return the build manifest of the tile folder, an empty one if missing"""
+
+        try:
+            with open(os.path.join(self.tile_folder, MANIFEST)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _write_manifest(self, manifest):
+        path = os.path.join(_get_or_create_path(self.tile_folder), MANIFEST)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(manifest, f, sort_keys=True, indent=4)
+        os.replace(path + '.tmp', path)
+
+    @metrics.timed('tile', process=True)
+    def tile(self, force=False):
+        """Create the tiles of all faces which are missing or stale.
 
-    def fallback(self, force=False):
-        """Scaling down the cubic faces as fallback option."""
-        if hasattr(self, 'faces'):
-            for f, image in self.faces:
-                if not os.path.isfile(image):
-                    logger.info(" face %s not found", f)
-                else:
-                    logger.debug("fallback face %s", f)
-                    fallback_dir = _get_or_create_path(os.path.join(self.tile_folder, 'fallback'))
-                    face = PIL.Image.open(image)
-                    if face.mode == 'RGBA':
-                        face = face.convert('RGB')
-                    face = face.resize([1024, 1024], PIL.Image.ANTIALIAS)
-                    face.save(os.path.join(fallback_dir, f + '.jpg'), quality=self.image_quality)
+        A manifest in the tile folder records the panorama, the parameters and
+        the completed faces. If any of them changed, or with ``force``, all
+        tiles are created again; an interrupted build resumes at the first
+        missing face.
+        """
+
+        levels = self.maxLevel
+        tile_size = self.tileResolution
+        if self.dedup:
+            # the files registered by an earlier run may be gone
+            self.encoder.reset()
+        manifest = self.read_manifest()
+        source = self._source_identity(manifest.get('source'))
+        params = self._build_params()
+        if force or manifest.get('source', {}).get('sha1') != source['sha1'] or manifest.get('params') != params:
+            logger.info("Tiles of %s are missing or stale", self.scene_id)
+            for level in os.listdir(self.tile_folder) if os.path.isdir(self.tile_folder) else []:
+                if level.isdigit():
+                    shutil.rmtree(os.path.join(self.tile_folder, level))
+            if self.archive:
+                self.encoder.archive.clear()
+            manifest = {'faces': []}
+        manifest['source'] = source
+        manifest['params'] = params
+
+        todo = [f for f in FACES if f not in manifest['faces']]
+        if not todo:
+            logger.info("Skipping extraction and tile creation, %s is up to date", self.tile_folder)
+            return
+
+        if self.low_memory and self.remapper == 'numpy':
+            self._write_manifest(manifest)
+            self._tile_low_memory(manifest, todo)
+            self._finish_tiles(manifest)
+            return
+
+        if self.keep_faces:
+            faces = self._disk_faces(manifest, todo)
+        else:
+            faces = self._extract_faces(todo)
+
+        params = (self.cubeResolution, levels, tile_size, self.tile_folder, self.encoder, self.threads)
+
+        def done(f):
+            manifest['faces'].append(f)
+            self._write_manifest(manifest)
+            self.fallbacks.append(f)
+
+        if self.low_memory:
+            # the faces come from nona, tile them one after another
+            for f, image in faces:
+                _tile_face_strips(f, _file_strips(image, tile_size), *params,
+                                  fallback=self._fallback_image(f), resize_filter=self.resize_filter)
+                done(f)
+        elif self.workers > 1:
+            # a face is only extracted once a process is free for it
+            with concurrent.futures.ProcessPoolExecutor(self.workers) as pool:
+                pending = {}
+                for f, image in faces:
+                    if len(pending) >= self.workers:
+                        finished, unfinished = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                        for future in finished:
+                            metrics.merge(future.result())
+                            done(pending.pop(future))
+                    pending[pool.submit(_tile_face_measured, f, image, *params,
+                                        self._fallback_image(f), self.resize_filter)] = f
+                for future in concurrent.futures.as_completed(pending):
+                    metrics.merge(future.result())
+                    done(pending[future])
         else:
-            logger.error("no faces for %s", self.scene_id)
+            for f, image in faces:
+                _tile_face(f, image, *params, self._fallback_image(f), self.resize_filter)
+                done(f)
+        self._finish_tiles(manifest, linked=self.low_memory or self.workers <= 1)
+
+    def _finish_tiles(self, manifest, linked=True):
+        """Close the archive, or record the tiles saved by linking duplicates.
+
+        Unless all tiles were ``linked`` within this process, the duplicates
+        between faces tiled by different processes are linked now.
+        """
+
+        if self.archive:
+            self.encoder.close()
+        if not self.dedup:
+            return
+        if linked:
+            stats = self.encoder.stats
+        else:
+            stats = self.encoder.link_tree(self.tile_folder)
+        logger.info("%s of %s tiles linked, %d kB saved", stats['linked'], stats['tiles'], stats['bytes_saved'] // 1024)
+        manifest['dedup'] = stats
+        self._write_manifest(manifest)
+
+    def _exists(self, filename):
+        """whether a tile or fallback image was written"""
+
+        if self.archive:
+            return self.encoder.exists(filename)
+        return os.path.isfile(filename)
+
+    @metrics.timed('fallback', process=True)
+    def fallback(self, force=False):
+        """Scaling down the cubic faces as fallback option.
+
+        Tiling already writes the fallback images, so a face is only scaled
+        down here if its fallback image is missing, or again with ``force``
+        unless it was made by tiling just now. Faces not kept on disk are
+        extracted again.
+        """
+
+        missing = []
+        for f, image in self.faces or list(zip(FACES, self._face_images())):
+            filename = self._fallback_image(f)
+            if f in self.fallbacks or (self._exists(filename) and not force):
+                logger.debug("fallback face %s exists", f)
+            elif not (self.keep_faces and os.path.isfile(image)):
+                missing.append(f)
+            else:
+                logger.debug("fallback face %s", f)
+                face = Image.open(image)
+                if face.mode == 'RGBA':
+                    face = face.convert('RGB')
+                _save_fallback(face, filename, self.encoder, self.resize_filter)
+        for f, face in self._extract_faces(missing) if missing else []:
+            logger.debug("fallback face %s", f)
+            _save_fallback(face, self._fallback_image(f), self.encoder, self.resize_filter)
+        if self.archive:
+            self.encoder.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,125 @@
+#!/usr/bin/env  python
+# -*- coding: utf-8 -*-
+"""Build the scenes of a tour concurrently within a memory budget.
+"""
+
+import logging
+import os
+import threading
+import time
+import traceback
+
+logger = logging.getLogger('pannellum.scheduler')
+
+# bytes per pixel of the decoded panorama and of a face while remapping and tiling
+SOURCE_BYTES_PER_PIXEL = 4
+FACE_BYTES_PER_PIXEL = 16
+
+
+def physical_memory():
+    """Return the size of the physical memory in bytes, None if unknown"""
+
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def estimate_memory(scene):
+    """Estimate the peak memory needed to build a scene, in bytes.
+
+    The decoded panorama is held while the faces are remapped, each face is
+    held in several copies while being tiled, once per tiling process. In low
+    memory mode only a few rows of tiles per level are held instead. Faces
+    not kept on disk are written by nona to a temporary folder, which may be
+    in memory.
+    """
+
+    source = scene.width * scene.height * SOURCE_BYTES_PER_PIXEL
+    if scene.remapper == 'nona' and not scene.keep_faces:
+        source += 6 * scene.cubeResolution ** 2 * SOURCE_BYTES_PER_PIXEL
+    if scene.low_memory:
+        return source + scene.cubeResolution * scene.tileResolution * FACE_BYTES_PER_PIXEL
+    face = scene.cubeResolution ** 2 * FACE_BYTES_PER_PIXEL
+    return source + face * max(scene.workers, 1)
+
+
+def build(scene, force=False):
+    """The default job: extract, tile and scale down a scene."""
+
+    scene.tile(force=force)
+    scene.fallback(force=force)
+
+
+class Scheduler:
+    """Run a job for every scene in a pool of threads.
+
+    A scene is only started if its estimated memory fits into what is left of
+    ``memory_budget``, a scene larger than the whole budget runs on its own.
+    Failures are logged and collected, the remaining scenes are still built.
+    """
+
+    def __init__(self, scenes, **kwargs):
+
+        self.scenes = scenes
+        self.jobs = max(kwargs.get('jobs', 1), 1)
+        self.memory_budget = kwargs.get('memory_budget', None) or physical_memory()
+        self.force = kwargs.get('force', False)
+        self.job = kwargs.get('job', build)
+        self.progress = kwargs.get('progress', None)
+        self._condition = threading.Condition()
+        self._memory = 0
+        self._running = 0
+
+    def _fits(self, needed):
+        if self._running == 0:
+            return True
+        if self._running >= self.jobs:
+            return False
+        return not self.memory_budget or self._memory + needed <= self.memory_budget
+
+    def _report(self, scene, status, done):
+        logger.info("[%s/%s] %s: %s", done, len(self.scenes), scene.scene_id, status)
+        if self.progress:
+            self.progress(scene, status, done, len(self.scenes))
+
+    def _run(self, scene, needed, summary):
+        start = time.time()
+        try:
+            self.job(scene, force=self.force)
+            status = 'done'
+        except Exception as e:
+            logger.error("building %s failed: %s", scene.scene_id, e)
+            summary['failed'][scene.scene_id] = traceback.format_exc()
+            status = 'failed'
+        with self._condition:
+            self._memory -= needed
+            self._running -= 1
+            summary['seconds'][scene.scene_id] = time.time() - start
+            if status == 'done':
+                summary['done'].append(scene.scene_id)
+            self._report(scene, status, len(summary['done']) + len(summary['failed']))
+            self._condition.notify_all()
+
+    def run(self):
+        """Build all scenes and return a summary of the run."""
+
+        summary = {'done': [], 'failed': {}, 'seconds': {}}
+        start = time.time()
+        threads = []
+        for scene in self.scenes:
+            needed = estimate_memory(scene)
+            with self._condition:
+                self._condition.wait_for(lambda: self._fits(needed))
+                self._memory += needed
+                self._running += 1
+            logger.info("starting %s (~%d MB)", scene.scene_id, needed // 2 ** 20)
+            thread = threading.Thread(target=self._run, args=(scene, needed, summary))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        summary['elapsed'] = time.time() - start
+        logger.info("%s scenes built, %s failed in %.1fs",
+                    len(summary['done']), len(summary['failed']), summary['elapsed'])
+        return summary
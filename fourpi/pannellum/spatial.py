@@ -0,0 +1,96 @@
+#!/usr/bin/env  python
+# -*- coding: utf-8 -*-
+"""Find neighbouring scenes by their GPS position.
+"""
+
+import heapq
+import math
+
+from fourpi.pannellum.utils import AVG_EARTH_RADIUS, haversine
+
+
+def _to_xyz(latlng):
+    """position on the unit sphere"""
+
+    lat, lng = map(math.radians, latlng)
+    return (math.cos(lat) * math.cos(lng), math.cos(lat) * math.sin(lng), math.sin(lat))
+
+
+def _chord(kilometer):
+    """straight distance on the unit sphere for a great-circle distance"""
+
+    return 2 * math.sin(min(kilometer / AVG_EARTH_RADIUS, math.pi) / 2)
+
+
+class SpatialIndex:
+    """A k-d tree over the positions of the scenes.
+
+    The positions are mapped onto the unit sphere, where the straight
+    distance grows with the great-circle distance, so neighbours can be
+    found in O(log N) instead of comparing every pair of scenes.
+    """
+
+    def __init__(self, exifdata):
+
+        points = [(_to_xyz(exif['latlng']), scene_id, exif['latlng'])
+                  for scene_id, exif in exifdata.items() if exif.get('latlng')]
+        self.size = len(points)
+        self.root = self._build(points, 0)
+
+    def _build(self, points, axis):
+        if not points:
+            return None
+        points.sort(key=lambda point: point[0][axis])
+        median = len(points) // 2
+        next_axis = (axis + 1) % 3
+        return (points[median], axis,
+                self._build(points[:median], next_axis),
+                self._build(points[median + 1:], next_axis))
+
+    def nearest(self, latlng, k=None, radius=None, exclude=None):
+        """Return (kilometer, scene_id) of the k nearest scenes within radius km.
+
+        Without ``k`` all scenes within ``radius`` are returned, the closest first.
+        """
+
+        target = _to_xyz(latlng)
+        limit = _chord(radius) ** 2 if radius is not None else float('inf')
+        found = []  # heap of (-squared distance, scene_id, latlng)
+
+        def bound():
+            if k and len(found) == k:
+                return min(limit, -found[0][0])
+            return limit
+
+        # subtrees with a lower bound of their squared distance
+        stack = [(self.root, 0)]
+        while stack:
+            node, gap = stack.pop()
+            if node is None or gap > bound():
+                continue
+            (xyz, scene_id, position), axis, left, right = node
+            distance = sum((a - b) ** 2 for a, b in zip(xyz, target))
+            if distance <= bound() and scene_id != exclude:
+                heapq.heappush(found, (-distance, scene_id, position))
+                if k and len(found) > k:
+                    heapq.heappop(found)
+            delta = target[axis] - xyz[axis]
+            near, far = (left, right) if delta < 0 else (right, left)
+            stack.append((far, delta ** 2))
+            stack.append((near, gap))
+        return sorted((haversine(latlng, position), scene_id) for d, scene_id, position in found)
+
+
+def neighbours(scene_id, exifdata, max_hotspots=None, max_distance=None, spatial_index=None):
+    """Return the scenes scene_id links to, the nearest first if limited.
+
+    ``max_hotspots`` and ``max_distance`` (in km) limit the hotspots to the
+    nearest scenes, looked up in ``spatial_index``. Scenes without GPS
+    position link to all others.
+    """
+
+    latlng = exifdata.get(scene_id, {}).get('latlng', None)
+    if not (max_hotspots or max_distance) or not latlng:
+        return [other for other in exifdata.keys() if other != scene_id]
+    index = spatial_index or SpatialIndex(exifdata)
+    return [other for distance, other in index.nearest(latlng, max_hotspots, max_distance, exclude=scene_id)]
@@ -2,46 +2,97 @@
 # -*- coding: utf-8 -*-
 
 import configparser
+import io
 import json
 import os
+import sys
 import logging
 import argparse
-from fourpi.pannellum.scene import Scene
-from fourpi.pannellum.exif import Exif
-from fourpi.pannellum.scene import DEFAULT_IMAGE_FORMAT, DEFAULT_IMAGE_QUALITY, DEFAULT_RESIZE_FILTER
+from fourpi.pannellum.scene import Scene, linked_digest
+from fourpi.pannellum.exif import Exif, BACKENDS as EXIF_BACKENDS, DEFAULT_BACKEND as DEFAULT_EXIF_BACKEND
+from fourpi.pannellum.cache import MetadataCache, ConfCache, EXIF_CACHE, CONF_CACHE, TILE_CACHE_BYTES
+from fourpi.pannellum.scheduler import Scheduler
+from fourpi.pannellum.spatial import SpatialIndex
+from fourpi.pannellum import hotspot
+from fourpi.pannellum import utils
+from fourpi.pannellum.utils import _scene_id_from_image, _get_or_create_path
+from fourpi.pannellum.scene import DEFAULT_IMAGE_FORMAT, DEFAULT_IMAGE_QUALITY, RESIZE_FILTERS
+from fourpi.pannellum.encoder import TILE_FORMATS
+from fourpi.pannellum.dedup import LINKS
+from fourpi.pannellum.metrics import metrics
+from fourpi.pannellum.scene import REMAPPERS, DEFAULT_REMAPPER
+from fourpi.pannellum.remap import INTERPOLATIONS, DEFAULT_INTERPOLATION, LookupTables
+
+INDEX = 'index.json'
+SCENE_FOLDER = 'scenes'
+# scenes whose hotspots are made at once while writing the configuration
+CHUNK_SCENES = 64
 
 logger = logging.getLogger('pannellum')
 
 
 class Tour:
 
+    @metrics.timed('tour')
     def __init__(self, exifdata, panoramas=[], **kwargs):
 
         # self.read_configuration()
         self.panoramas = panoramas
         self.debug = kwargs.get('debug', False)
-        tile_folder = kwargs.get('tile_folder', None)
+        tile_folder = kwargs.get('tile_folder', '')
         basePath = kwargs.get('basePath', None)
 
-        self.conf = {}
         default = {}
         author = kwargs.get('author', None)
         autoRotate = kwargs.get('autoRotate', 0)
         sceneFadeDuration = kwargs.get('sceneFadeDuration', 0)
+        image_quality = kwargs.get('image_quality', 0.9)
+        tile_format = kwargs.get('tile_format', DEFAULT_IMAGE_FORMAT)
+        resize_filter = kwargs.get('resize_filter', 'antialias')
+        dedup = kwargs.get('dedup', None)
+        archive = kwargs.get('archive', False)
+        remapper = kwargs.get('remapper', DEFAULT_REMAPPER)
+        interpolation = kwargs.get('interpolation', DEFAULT_INTERPOLATION)
+        lookup_tables = kwargs.get('lookup_tables', None)
+        workers = kwargs.get('workers', 1)
+        threads = kwargs.get('threads', 1)
+        low_memory = kwargs.get('low_memory', False)
+        keep_faces = kwargs.get('keep_faces', False)
+        max_hotspots = kwargs.get('max_hotspots', None)
+        max_distance = kwargs.get('max_distance', None)
+        tune = kwargs.get('tune', False)
+        spatial_index = SpatialIndex(exifdata) if max_hotspots or max_distance else None
+        self.exifdata = exifdata
+        self.conf_cache = kwargs.get('conf_cache', None)
 
-        scenes_conf = {}
+        # the scenes make their configuration on first use
         self.scenes = []
         for panorama in panoramas:
             scene = Scene(panorama,
                           exifdata=exifdata,
-                          image_quality=0.9,
+                          image_quality=image_quality,
+                          tile_format=tile_format,
+                          resize_filter=resize_filter,
+                          dedup=dedup,
+                          archive=archive,
                           autoRotate=autoRotate,
                           basePath=basePath,
-                          tile_folder=tile_folder)
+                          tile_folder=tile_folder,
+                          remapper=remapper,
+                          interpolation=interpolation,
+                          lookup_tables=lookup_tables,
+                          workers=workers,
+                          threads=threads,
+                          low_memory=low_memory,
+                          keep_faces=keep_faces,
+                          max_hotspots=max_hotspots,
+                          max_distance=max_distance,
+                          tune=tune,
+                          spatial_index=spatial_index,
+                          conf_cache=self.conf_cache)
             self.scenes.append(scene)
-            scenes_conf[scene.scene_id] = scene.conf
 
-        firstScene = kwargs.get('firstScene', list(scenes_conf.keys())[0])
+        firstScene = kwargs.get('firstScene', self.scenes[0].scene_id)
         default['firstScene'] = firstScene
         default['autoLoad'] = True
         if author:
@@ -51,8 +102,56 @@ class Tour:
         if sceneFadeDuration:
             default['sceneFadeDuration'] = sceneFadeDuration
 
-        self.conf['default'] = default
-        self.conf['scenes'] = scenes_conf
+        self.default = default
+
+    def _hotspots(self, scenes):
+        """hotspots of the scenes not taken from the conf_cache at once, if numpy is around"""
+
+        if not utils.numpy:
+            return
+        stale = [scene for scene in scenes if scene.scene_id in self.exifdata and not scene.cached()]
+        if not stale:
+            return
+        with metrics.stage('tour.hotspots'):
+            hotspots = hotspot.get_confs(self.exifdata, dict((scene.scene_id, scene._neighbours()) for scene in stale))
+        for scene in stale:
+            scene.hotspots = hotspots.get(scene.scene_id, None)
+
+    def _link_scenes(self):
+        """hand the digest of all scenes to the scenes linking to all others, made once per output"""
+
+        digest = linked_digest(self.exifdata)
+        for scene in self.scenes:
+            scene.linked_digest = digest
+
+    def _unique_scenes(self):
+        self._link_scenes()
+        # the last scene of an id wins, at the place of the first
+        scenes = dict((scene.scene_id, scene) for scene in self.scenes)
+        if self.debug:
+            return [scenes[scene_id] for scene_id in sorted(scenes)]
+        return list(scenes.values())
+
+    def _scene_confs(self):
+        """Yield (scene, conf) of the unique scenes.
+
+        The hotspots are made for CHUNK_SCENES scenes at once. A scene's
+        configuration is dropped once yielded, so writing a large tour
+        does not hold all of them.
+        """
+
+        scenes = self._unique_scenes()
+        for first in range(0, len(scenes), CHUNK_SCENES):
+            chunk = scenes[first:first + CHUNK_SCENES]
+            self._hotspots(chunk)
+            for scene in chunk:
+                yield scene, scene.conf
+                scene.forget()
+
+    @property
+    def conf(self):
+        return {'default': self.default,
+                'scenes': dict((scene.scene_id, conf) for scene, conf in self._scene_confs())}
 
     def read_configuration(self):
         cwd = os.getcwd()
@@ -64,11 +163,67 @@ class Tour:
         print(author)
         header = config.get('default', 'header')
 
-    def get_json(self):
+    def _dumps(self, value, depth=0):
         if self.debug:
-            return json.dumps(self.conf, sort_keys=True, indent=4, separators=(', ', ': '))
+            text = json.dumps(value, sort_keys=True, indent=4, separators=(', ', ': '))
+            return text.replace('\n', '\n' + '    ' * depth)
+        return json.dumps(value, sort_keys=False, indent=None, separators=(',', ':'))
+
+    def _write_tour(self, fp, scenes):
+        """write default and the (scene_id, conf) pairs of scenes as one JSON object"""
+
+        if self.debug:
+            newline, indent, colon, comma = '\n', '    ', ': ', ', '
         else:
-            return json.dumps(self.conf, sort_keys=False, indent=None, separators=(',', ':'))
+            newline, indent, colon, comma = '', '', ':', ','
+        fp.write('{%s%s"default"%s%s%s%s%s"scenes"%s{' % (
+            newline, indent, colon, self._dumps(self.default, 1), comma, newline, indent, colon))
+        for i, (scene_id, conf) in enumerate(scenes):
+            fp.write('%s%s%s%s%s%s' % (comma if i else '', newline, indent * 2, json.dumps(scene_id), colon,
+                                       self._dumps(conf, 2)))
+        fp.write('%s%s}%s}' % (newline, indent, newline))
+
+    @metrics.timed('tour.json')
+    def get_json(self):
+        fp = io.StringIO()
+        self.write_json(fp)
+        return fp.getvalue()
+
+    def write_json(self, fp):
+        """Write the configuration to the file object fp, one scene at a time"""
+
+        self._write_tour(fp, ((scene.scene_id, conf) for scene, conf in self._scene_confs()))
+
+    @metrics.timed('tour.json')
+    def write_split(self, folder):
+        """Write an index and a configuration fragment per scene into folder.
+
+        The index holds the default configuration and the scenes with their
+        title and the path of their fragment, relative to the index, so a
+        viewer can fetch a scene's configuration once it is entered.
+        """
+
+        _get_or_create_path(os.path.join(folder, SCENE_FOLDER))
+
+        def scenes():
+            for scene, conf in self._scene_confs():
+                fragment = '%s/%s.json' % (SCENE_FOLDER, scene.scene_id)
+                with open(os.path.join(folder, fragment), 'w') as f:
+                    f.write(self._dumps(conf))
+                yield scene.scene_id, {'title': conf.get('title', scene.scene_id), 'config': fragment}
+
+        with open(os.path.join(folder, INDEX), 'w') as f:
+            self._write_tour(f, scenes())
+
+    def tuning(self):
+        """the tuner's report of every tuned scene, without the rejected candidates"""
+
+        reports = {}
+        for scene in self._unique_scenes():
+            if scene.tuning:
+                reports[scene.scene_id] = dict((key, value) for key, value in scene.tuning.items()
+                                               if key != 'candidates')
+        return reports
 
 
 def main():
@@ -86,10 +241,65 @@ def main():
     parser.add_argument('-o', '--tile_folder', help='Tile folder', default='')
     parser.add_argument('-q', '--image_quality', type=float,
                         default=DEFAULT_IMAGE_QUALITY, help='Quality of the image output (0-1). Default: 0.8')
-    parser.add_argument('--tile_format',
-                        default=DEFAULT_IMAGE_FORMAT, help='Image format of the tiles (jpg or png). Default: jpg')
-    parser.add_argument('--resize_filter', default=DEFAULT_RESIZE_FILTER,
+    parser.add_argument('--tile_format', choices=sorted(TILE_FORMATS), default=DEFAULT_IMAGE_FORMAT,
+                        help='Image format of the tiles. Default: %s' % DEFAULT_IMAGE_FORMAT)
+    parser.add_argument('--resize_filter', choices=sorted(RESIZE_FILTERS), default='antialias',
                         help='Type of filter for resizing (bicubic, nearest, bilinear, antialias (best). Default: antialias')
+    parser.add_argument('--dedup', choices=LINKS,
+                        help='Write identical tiles once, the duplicates become hard or symbolic links.')
+    parser.add_argument('--archive', action="store_true",
+                        help='Write the tiles of each scene into one archive file, see pannellum-serve.')
+    parser.add_argument('--serve', type=int, metavar='PORT',
+                        help='Serve the tiles on this port, rendering them on first request.')
+    parser.add_argument('--cache_size', type=int,
+                        help='Memory in MB for tiles rendered by --serve. Default: %d' % (TILE_CACHE_BYTES // 2 ** 20))
+    parser.add_argument('--disk_cache', action="store_true",
+                        help='Keep the tiles rendered by --serve in the tile folder.')
+    parser.add_argument('--output', metavar='FILE',
+                        help='Write the configuration to this file instead of printing it.')
+    parser.add_argument('--split', metavar='FOLDER',
+                        help='Write an index %s and a configuration per scene below %s/ into this folder.' % (INDEX, SCENE_FOLDER))
+    parser.add_argument('--profile', metavar='FILE',
+                        help='Write the time and CPU time of every stage, the tiles written and the peak memory as JSON.')
+    parser.add_argument('--prometheus', metavar='FILE',
+                        help='Write the same measurements for the textfile collector of the Prometheus node exporter.')
+    parser.add_argument('--remapper', choices=REMAPPERS, default=DEFAULT_REMAPPER,
+                        help='Remap the faces with nona or in process with numpy. Default: %s' % DEFAULT_REMAPPER)
+    parser.add_argument('--interpolation', choices=INTERPOLATIONS, default=DEFAULT_INTERPOLATION,
+                        help='Interpolation of the numpy remapper. Default: %s' % DEFAULT_INTERPOLATION)
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='Number of processes tiling the faces of a scene. Default: 1')
+    parser.add_argument('--threads', type=int, default=1,
+                        help='Number of threads encoding the tiles of a face. Default: 1')
+    parser.add_argument('--max_hotspots', type=int,
+                        help='Link each scene only to this many of its nearest scenes.')
+    parser.add_argument('--max_distance', type=float,
+                        help='Link each scene only to scenes within this distance in km.')
+    parser.add_argument('--tune', action="store_true",
+                        help='Choose face and tile size of each scene by a cost model of tiles, bytes and requests. '
+                             'The cheapest candidates are logged with -v.')
+    parser.add_argument('--tune_report', metavar='FILE',
+                        help='Write why the tuner chose the face and tile size of each scene as JSON.')
+    parser.add_argument('--low_memory', action="store_true",
+                        help='Tile the faces in strips, holding only about one row of tiles per level.')
+    parser.add_argument('--keep_faces', action="store_true",
+                        help='Keep the extracted cubic faces as TIFF files next to the panorama, e.g. for debugging.')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of scenes built, and of files read for their metadata, concurrently. Default: 1')
+    parser.add_argument('--memory_budget', type=int,
+                        help='Memory in MB available to concurrent scenes. Default: physical memory')
+    parser.add_argument('--lut_folder',
+                        help='Folder to keep the lookup tables of the numpy remapper between runs.')
+    parser.add_argument('--exif_cache',
+                        help='Metadata cache file. Default: %s in the tile folder' % EXIF_CACHE)
+    parser.add_argument('--no_exif_cache', action="store_true", help="Always read the metadata of the panoramas.")
+    parser.add_argument('--exif_backend', choices=EXIF_BACKENDS, default=DEFAULT_EXIF_BACKEND,
+                        help='Read JPEG metadata in python, other files with exiftool (auto), or all with one of them. '
+                             'Default: %s' % DEFAULT_EXIF_BACKEND)
+    parser.add_argument('--refresh_exif', action="store_true", help="Invalidate the metadata cache.")
+    parser.add_argument('--conf_cache',
+                        help='Cache of the scene configurations. Default: %s in the tile folder' % CONF_CACHE)
+    parser.add_argument('--no_conf_cache', action="store_true", help="Always make the configuration of every scene.")
 
     args = parser.parse_args()
 
@@ -100,21 +310,82 @@ def main():
     console = logging.StreamHandler()
     logger.addHandler(console)
 
-    e = Exif(args.panoramas)
+    cache = None
+    if not args.no_exif_cache:
+        cache_file = args.exif_cache or os.path.join(args.tile_folder, EXIF_CACHE)
+        cache = MetadataCache(cache_file, refresh=args.refresh_exif)
+
+    e = Exif(args.panoramas, cache=cache, jobs=max(args.jobs, 1), backend=args.exif_backend)
     exifdata = e.get_exifdata()
+    if cache:
+        cache.close()
+    panoramas = [p for p in args.panoramas if _scene_id_from_image(p) in exifdata]
+
+    conf_cache = None
+    if not args.no_conf_cache:
+        conf_cache = ConfCache(args.conf_cache or os.path.join(args.tile_folder, CONF_CACHE),
+                               refresh=args.refresh_exif)
 
     tour = Tour(author=args.author,
                 debug=args.debug,
                 tile_folder=args.tile_folder,
+                image_quality=args.image_quality,
+                tile_format=args.tile_format,
+                resize_filter=args.resize_filter,
+                dedup=args.dedup,
+                archive=args.archive,
+                remapper=args.remapper,
+                interpolation=args.interpolation,
+                lookup_tables=LookupTables(args.lut_folder) if args.lut_folder else None,
+                workers=args.workers,
+                threads=args.threads,
+                low_memory=args.low_memory,
+                keep_faces=args.keep_faces,
+                max_hotspots=args.max_hotspots,
+                max_distance=args.max_distance,
+                tune=args.tune,
+                conf_cache=conf_cache,
                 exifdata=exifdata,
-                panoramas=args.panoramas)
+                panoramas=panoramas)
 
     if args.tile:
-        for scene in tour.scenes:
-            scene.tile(force=args.force)
-            scene.fallback(force=args.force)
+        memory_budget = args.memory_budget * 2 ** 20 if args.memory_budget else None
+        scheduler = Scheduler(tour.scenes, jobs=args.jobs, memory_budget=memory_budget, force=args.force)
+        summary = scheduler.run()
+        for scene_id in summary['failed']:
+            logger.error("%s failed:\n%s", scene_id, summary['failed'][scene_id])
 
-    print(tour.get_json())
+    if args.split:
+        tour.write_split(args.split)
+    elif args.output:
+        with open(args.output, 'w') as f:
+            tour.write_json(f)
+    else:
+        tour.write_json(sys.stdout)
+        sys.stdout.write('\n')
+    if conf_cache:
+        conf_cache.close()
+    if args.tune_report:
+        with open(args.tune_report, 'w') as f:
+            json.dump(tour.tuning(), f, sort_keys=True, indent=4)
+
+    if args.profile:
+        metrics.write_json(args.profile)
+    if args.prometheus:
+        metrics.write_prometheus(args.prometheus)
+
+    if args.serve:
+        from fourpi.pannellum import lazy
+        cache_bytes = args.cache_size * 2 ** 20 if args.cache_size else lazy.CACHE_BYTES
+        httpd = lazy.server(tour.scenes, args.serve, cache_bytes=cache_bytes,
+                            disk_cache=args.disk_cache)
+        logger.warning("Serving tiles on http://127.0.0.1:%s/", args.serve)
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            httpd.server_close()
 
 
 if __name__ == "__main__":
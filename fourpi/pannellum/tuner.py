@@ -0,0 +1,156 @@
+#!/usr/bin/env  python
+# -*- coding: utf-8 -*-
+"""Choose the face and tile size of a multires scene with a cost model.
+
+Every candidate (cubeResolution, tileResolution, maxLevel) is rated by the
+number of tiles written, an estimate of their encoded bytes, and the tiles
+requested and bytes loaded to show a typical viewport, each relative to the
+configuration ``Scene`` picks by default. The cheapest one wins.
+
+The cube resolution of a candidate is divisible by ``2 ** (maxLevel - 1)``,
+so halving it for the lower levels gives the same number of tiles in
+pannellum as while tiling, and the lowest level, only that one, is a single
+tile.
+"""
+
+import math
+
+TILE_SIZES = range(256, 1025, 64)
+# fraction of the width of the faces that may be given up
+MAX_RESOLUTION_LOSS = 0.02
+# rough JPEG figures at the default quality of photographic content
+BYTES_PER_PIXEL = 0.3
+TILE_OVERHEAD = 700
+# a full HD browser window at pannellum's default field of view
+VIEWPORT = (1920, 1080)
+VIEWPORT_HFOV = 100
+COST_WEIGHTS = {'tiles': 1.0, 'bytes': 1.0, 'requests': 1.0, 'viewport_bytes': 1.0}
+
+
+def _level_sizes(cube, max_level):
+    """face size of the levels 1 to max_level"""
+
+    return [cube // 2 ** (max_level - level) for level in range(1, max_level + 1)]
+
+
+def _viewport_level(tile, max_level, viewport=VIEWPORT, hfov=VIEWPORT_HFOV):
+    # as pannellum picks the level to show
+    level = 1
+    while level < max_level and viewport[0] > tile * 2 ** (level - 1) * math.tan(math.radians(hfov) / 2) * 0.707:
+        level += 1
+    return level
+
+
+def _visible_tiles(size, tile, viewport=VIEWPORT, hfov=VIEWPORT_HFOV):
+    """tiles of a level needed to fill the viewport, at most all of them"""
+
+    vfov = 2 * math.atan(math.tan(math.radians(hfov) / 2) * viewport[1] / viewport[0])
+    across = math.ceil(size * math.tan(math.radians(hfov) / 2) / tile) + 1
+    down = math.ceil(size * math.tan(vfov / 2) / tile) + 1
+    return min(across * down, 6 * math.ceil(size / tile) ** 2)
+
+
+def rate(cube, tile, max_level, **kwargs):
+    """Return the costs of a configuration"""
+
+    viewport = kwargs.get('viewport', VIEWPORT)
+    hfov = kwargs.get('hfov', VIEWPORT_HFOV)
+    bytes_per_pixel = kwargs.get('bytes_per_pixel', BYTES_PER_PIXEL)
+    sizes = _level_sizes(cube, max_level)
+    tiles = sum(6 * math.ceil(size / tile) ** 2 for size in sizes)
+    pixels = sum(6 * size ** 2 for size in sizes)
+    level = _viewport_level(tile, max_level, viewport, hfov)
+    # the lower levels are shown while loading
+    requests = 0
+    viewport_bytes = 0
+    for size in sizes[:level]:
+        visible = _visible_tiles(size, tile, viewport, hfov)
+        requests += visible
+        viewport_bytes += min(visible * tile ** 2, 6 * size ** 2) * bytes_per_pixel + visible * TILE_OVERHEAD
+    return {
+        'cubeResolution': cube,
+        'tileResolution': tile,
+        'maxLevel': max_level,
+        'tiles': tiles,
+        'partial_tiles': sum(6 * (2 * math.ceil(size / tile) - 1) for size in sizes if size % tile),
+        'bytes': int(pixels * bytes_per_pixel + tiles * TILE_OVERHEAD),
+        'requests': requests,
+        'viewport_bytes': int(viewport_bytes),
+    }
+
+
+def candidates(width, **kwargs):
+    """Return (cube, tile, maxLevel) of the configurations worth rating for a panorama width"""
+
+    raw_face_width = width / math.pi
+    max_loss = kwargs.get('max_loss', MAX_RESOLUTION_LOSS)
+    found = set()
+    for tile in kwargs.get('tile_sizes', TILE_SIZES):
+        levels = max(1, int(math.ceil(math.log(raw_face_width / tile, 2))) + 1)
+        for max_level in (levels, levels + 1):
+            step = 2 ** (max_level - 1)
+            # the largest divisible face, and the largest without partial tiles
+            for multiple in (step, tile * step // math.gcd(tile, step)):
+                cube = int(raw_face_width // multiple * multiple)
+                if not cube or cube < raw_face_width * (1 - max_loss) or cube // step > tile:
+                    continue
+                # only the lowest level is a single tile
+                if max_level == 1 or cube // (step // 2) > tile:
+                    found.add((cube, tile, max_level))
+    return sorted(found)
+
+
+def _score(costs, baseline, weights):
+    return sum(weight * costs[key] / max(baseline[key], 1) for key, weight in weights.items())
+
+
+def tune(width, default, **kwargs):
+    """Return a report with the cheapest configuration for a panorama width.
+
+    ``default`` is the (cube, tile, maxLevel) chosen without the tuner, the
+    costs are weighted by ``weights`` relative to it. The report holds the
+    ``chosen`` and the ``default`` configuration with their costs, all
+    ``candidates`` from the cheapest and the ``reason`` of the choice.
+    """
+
+    weights = kwargs.get('weights', COST_WEIGHTS)
+    baseline = rate(*default, **kwargs)
+    baseline['score'] = _score(baseline, baseline, weights)
+    rated = [baseline]
+    for cube, tile, max_level in candidates(width, **kwargs):
+        if (cube, tile, max_level) == tuple(default):
+            continue
+        costs = rate(cube, tile, max_level, **kwargs)
+        costs['score'] = _score(costs, baseline, weights)
+        rated.append(costs)
+    # ties go to the larger face, then to the smaller tile
+    rated.sort(key=lambda costs: (round(costs['score'], 6), -costs['cubeResolution'], costs['tileResolution']))
+    chosen = rated[0]
+    return {'chosen': chosen, 'default': baseline, 'candidates': rated, 'reason': _reason(chosen, baseline)}
+
+
+def _reason(chosen, default):
+    if chosen is default:
+        return "the default configuration is the cheapest of the candidates"
+    changes = []
+    for key in ('tiles', 'bytes', 'requests', 'viewport_bytes'):
+        change = chosen[key] / max(default[key], 1) - 1
+        changes.append("%+d%% %s" % (round(100 * change), key))
+    return ("cube %s, tile %s, %s levels instead of cube %s, tile %s, %s levels: %s, score %.3f" % (
+        chosen['cubeResolution'], chosen['tileResolution'], chosen['maxLevel'],
+        default['cubeResolution'], default['tileResolution'], default['maxLevel'],
+        ', '.join(changes), chosen['score']))
+
+
+def format_report(report, top=5):
+    """the report as text, with the cheapest candidates"""
+
+    lines = ["chosen: %s" % report['reason'],
+             "%8s %6s %6s %8s %8s %12s %9s %12s %7s" % ('cube', 'tile', 'levels', 'tiles', 'partial', 'bytes',
+                                                         'requests', 'view bytes', 'score')]
+    for costs in report['candidates'][:top]:
+        lines.append("%8s %6s %6s %8s %8s %12s %9s %12s %7.3f%s" % (
+            costs['cubeResolution'], costs['tileResolution'], costs['maxLevel'], costs['tiles'],
+            costs['partial_tiles'], costs['bytes'], costs['requests'], costs['viewport_bytes'], costs['score'],
+            ' (default)' if costs is report['default'] else ''))
+    return '\n'.join(lines)
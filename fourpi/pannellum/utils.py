@@ -1,7 +1,44 @@
-from math import radians, cos, sin, asin, sqrt
+from math import radians, degrees, cos, sin, asin, atan2, sqrt
+import functools
+import hashlib
+import importlib
+import importlib.util
 import os
+import shutil
+
+
+class _LazyModule:
+    """A module imported on first use of one of its attributes."""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attribute):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attribute)
+
+
+def _lazy_import(name):
+    """the module name, imported on first use, None if it is not installed"""
+
+    return _LazyModule(name) if importlib.util.find_spec(name) else None
+
+
+@functools.lru_cache(maxsize=None)
+def find_tool(name):
+    """Return the path of an executable, None if not found, looked up once"""
+
+    return shutil.which(name)
+
+
+numpy = _lazy_import('numpy')
+# installed anyway, only imported once images are read or written
+Image = _LazyModule('PIL.Image')
 
 AVG_EARTH_RADIUS = 6371  # in km
+MILES_PER_KILOMETER = 0.621371
 
 
 def haversine(point1, point2, miles=False):
@@ -30,11 +67,73 @@ def haversine(point1, point2, miles=False):
     d = sin(lat * 0.5) ** 2 + cos(lat1) * cos(lat2) * sin(lng * 0.5) ** 2
     h = 2 * AVG_EARTH_RADIUS * asin(sqrt(d))
     if miles:
-        return h * 0.621371  # in miles
+        return h * MILES_PER_KILOMETER  # in miles
     else:
         return h  # in kilometers
 
 
+def bearing(point1, point2):
+    """Return the initial bearing from point1 to point2 in degrees (0-360)."""
+
+    lat1, lng1 = point1
+    lat2, lng2 = point2
+    rlat1 = radians(lat1)
+    rlat2 = radians(lat2)
+    dlng = radians(lng2 - lng1)
+    b = atan2(sin(dlng) * cos(rlat2), cos(rlat1) * sin(rlat2) - sin(rlat1) * cos(rlat2) * cos(dlng))
+    return (degrees(b) + 360) % 360
+
+
+def hotspot_yaws(heading, northOffset=0, targetNorthOffset=0):
+    """Return yaw and targetYaw of a hotspot at the bearing heading, both normalised to 0-360.
+
+    Works on numbers as well as on numpy arrays.
+    """
+
+    yaw = heading - northOffset
+    targetYaw = yaw + northOffset - targetNorthOffset
+    return (yaw + 360) % 360, (targetYaw + 360) % 360
+
+
+def haversine_pairs(lat1, lng1, lat2, lng2, miles=False):
+    """Vectorized haversine for arrays of latitudes and longitudes.
+
+    The arrays are broadcast against each other, so pairs of points as well
+    as rows against columns can be computed in one pass.
+    """
+
+    lat1, lng1, lat2, lng2 = (numpy.radians(numpy.asarray(a, dtype=float)) for a in (lat1, lng1, lat2, lng2))
+    d = numpy.sin((lat2 - lat1) * 0.5) ** 2 + numpy.cos(lat1) * numpy.cos(lat2) * numpy.sin((lng2 - lng1) * 0.5) ** 2
+    h = 2 * AVG_EARTH_RADIUS * numpy.arcsin(numpy.sqrt(d))
+    if miles:
+        return h * MILES_PER_KILOMETER
+    return h
+
+
+def bearing_pairs(lat1, lng1, lat2, lng2):
+    """Vectorized bearing for arrays of latitudes and longitudes, see haversine_pairs."""
+
+    rlat1, rlat2 = numpy.radians(numpy.asarray(lat1, dtype=float)), numpy.radians(numpy.asarray(lat2, dtype=float))
+    dlng = numpy.radians(numpy.asarray(lng2, dtype=float) - numpy.asarray(lng1, dtype=float))
+    b = numpy.arctan2(numpy.sin(dlng) * numpy.cos(rlat2),
+                      numpy.cos(rlat1) * numpy.sin(rlat2) - numpy.sin(rlat1) * numpy.cos(rlat2) * numpy.cos(dlng))
+    return (numpy.degrees(b) + 360) % 360
+
+
+def haversine_matrix(latlngs, miles=False):
+    """Distances between all points of a sequence of (lat, lng) as n x n matrix."""
+
+    lat, lng = numpy.asarray(latlngs, dtype=float).reshape(-1, 2).T
+    return haversine_pairs(lat[:, None], lng[:, None], lat[None, :], lng[None, :], miles)
+
+
+def bearing_matrix(latlngs):
+    """Bearings from every point (rows) to every other point (columns)."""
+
+    lat, lng = numpy.asarray(latlngs, dtype=float).reshape(-1, 2).T
+    return bearing_pairs(lat[:, None], lng[:, None], lat[None, :], lng[None, :])
+
+
 def _expand(d):
     return os.path.abspath(os.path.expanduser(os.path.expandvars(d)))
 
@@ -43,10 +142,20 @@ def _get_or_create_path(path):
     """create a directory if it does not exist."""
 
     if not os.path.exists(path):
-        os.makedirs(path)
+        os.makedirs(path, exist_ok=True)
     return path
 
 
+def _digest(path, blocksize=1 << 20):
+    """sha1 of the files content"""
+
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
 def _scene_id_from_image(image):
     """create an id from the images filename"""
 
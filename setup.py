@@ -26,11 +26,16 @@ setup(name='fourpi.pannellum',
           'Pillow'
           # -*- Extra requirements: -*-
       ],
+      extras_require={
+          'numpy': ['numpy'],
+      },
       entry_points={
           'console_scripts':[
             'pannellum=fourpi.pannellum.tour:main',
             'exif2rst=fourpi.pannellum.exif:main',
             'eq2cyl=fourpi.pannellum.eq2cyl:main',
+            'pannellum-serve=fourpi.pannellum.archive:main',
+            'pannellum-benchmark=fourpi.pannellum.benchmark:main',
           ]  
       },
       )
@@ -1,9 +1,701 @@
+
+import datetime
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
 import unittest
 
+from fourpi.pannellum.exif import Exif
+from fourpi.pannellum.cache import MetadataCache, ConfCache
+from fourpi.pannellum import remap
+from fourpi.pannellum.scheduler import Scheduler
+from fourpi.pannellum.scene import Scene, FACES
+from fourpi.pannellum.spatial import SpatialIndex
+from fourpi.pannellum import hotspot, utils
+from fourpi.pannellum.hotspot import HotSpot
+from fourpi.pannellum.tour import Tour
+from fourpi.pannellum.utils import haversine
+
+PANOS = os.path.join(os.path.dirname(__file__), 'panos')
+
+
 class TestPannellum(unittest.TestCase):
     
     def test_test(self):
         self.assertTrue(True)
 
+
+class TestExif(unittest.TestCase):
+
+    def test_parse(self):
+        exif = {'ImageWidth': 2000, 'ImageHeight': 1000,
+                'GPSLatitude': 51.2, 'GPSLongitude': 6.7,
+                'ExposureTime': 0.004, 'CroppedAreaTopPixels': 10}
+        values = Exif()._parse('pano', exif)
+        self.assertEqual(values['width'], 2000)
+        self.assertEqual(values['latlng'], (51.2, 6.7))
+        self.assertEqual(values['exposure'], 250)
+        self.assertEqual(values['croppedTop'], 10.0)
+        self.assertEqual(values['fov'], 90)
+
+    def test_missing_file(self):
+        self.assertEqual(Exif(['does-not-exist.jpg']).get_exifdata(), {})
+
+    def test_python_backend(self):
+        exifdata = Exif([os.path.join(PANOS, 'pano2.jpg'), os.path.join(PANOS, 'partial.jpg')],
+                        backend='python').get_exifdata()
+        self.assertEqual(exifdata['pano2']['title'], 'Hyatt Hotel')
+        self.assertEqual(exifdata['pano2']['taken'], datetime.datetime(2013, 5, 4, 15, 1, 18))
+        self.assertEqual(exifdata['pano2']['exposure'], 250)
+        self.assertAlmostEqual(exifdata['pano2']['latlng'][0], 51.2164, places=4)
+        self.assertEqual(exifdata['pano2']['pan'], 80)
+        self.assertEqual((exifdata['partial']['width'], exifdata['partial']['height']), (3200, 337))
+        self.assertEqual(exifdata['partial']['croppedTop'], 563.0)
+        self.assertEqual(exifdata['partial']['panoHeight'], 1600.0)
+        # read by threads, jobs files at a time
+        panoramas = [os.path.join(PANOS, name) for name in sorted(os.listdir(PANOS)) if name.endswith('.jpg')]
+        self.assertEqual(Exif(panoramas, backend='python', jobs=3).get_exifdata(),
+                         Exif(panoramas, backend='python').get_exifdata())
+
+    def test_not_jpeg(self):
+        import PIL.Image
+        from fourpi.pannellum import jpeg
+        with tempfile.TemporaryDirectory() as folder:
+            filename = os.path.join(folder, 'pano.png')
+            PIL.Image.new('RGB', (40, 20)).save(filename)
+            self.assertIsNone(jpeg.read_tags(filename))
+
+    def test_rst(self):
+        from fourpi.pannellum import exif
+        self.assertEqual(exif.find_panoramas([PANOS, os.path.join(PANOS, 'pano1.jpg')])[:2],
+                         [os.path.join(PANOS, 'narrow.jpg'), os.path.join(PANOS, 'pano1.jpg')])
+        values = Exif()._parse('pano', {'ImageWidth': 2000, 'ImageHeight': 1000})
+        with tempfile.TemporaryDirectory() as folder:
+            filename = os.path.join(folder, 'pano.rst')
+            self.assertTrue(exif.write_rst(filename, 'pano', values))
+            with open(filename) as f:
+                text = f.read().replace(exif.now(), '2020-01-01')
+            with open(filename, 'w') as f:
+                f.write(text)
+            # unchanged, even on another day
+            self.assertFalse(exif.write_rst(filename, 'pano', values))
+            values['width'] = 4000
+            self.assertTrue(exif.write_rst(filename, 'pano', values))
+            with open(filename) as f:
+                self.assertIn(':date:     2020-01-01', f.read())
+
+
+class TestMetadataCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.pano = os.path.join(self.tmp, 'pano1.jpg')
+        shutil.copy(os.path.join(PANOS, 'pano1.jpg'), self.pano)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_roundtrip(self):
+        cache = MetadataCache(os.path.join(self.tmp, 'cache.sqlite'))
+        values = {'width': 2000, 'latlng': (51.2, 6.7),
+                  'taken': datetime.datetime(2016, 2, 13, 18, 3, 21)}
+        cache.set(self.pano, values)
+        self.assertEqual(cache.get(self.pano), values)
+        os.utime(self.pano, (0, 0))
+        self.assertIsNone(cache.get(self.pano))
+        cache.close()
+
+    def test_evict(self):
+        cache = MetadataCache(os.path.join(self.tmp, 'cache.sqlite'), max_entries=1)
+        other = os.path.join(self.tmp, 'pano2.jpg')
+        shutil.copy(os.path.join(PANOS, 'pano2.jpg'), other)
+        cache.set(self.pano, {'width': 1})
+        cache.set(other, {'width': 2})
+        cache.sync()
+        self.assertIsNone(cache.get(self.pano))
+        self.assertEqual(cache.get(other), {'width': 2})
+        cache.close()
+
+
+@unittest.skipUnless(remap.numpy, "numpy not installed")
+class TestRemap(unittest.TestCase):
+
+    def test_face_coordinates(self):
+        # the centre of the front face is the centre of the panorama
+        x, y = remap.face_coordinates(2, 0, 0, 400, 200)
+        self.assertAlmostEqual(float(x.mean()), 199.5, places=3)
+        self.assertAlmostEqual(float(y.mean()), 99.5, places=3)
+        # the left face looks at yaw -90
+        x, y = remap.face_coordinates(2, 90, 0, 400, 200)
+        self.assertAlmostEqual(float(x.mean()), 99.5, places=3)
+        # a shifted, cropped panorama moves the horizon
+        x, y = remap.face_coordinates(2, 0, 0, 400, 100, shift=20)
+        self.assertAlmostEqual(float(y.mean()), 69.5, places=3)
+
+    def test_remap_face(self):
+        image = remap.numpy.zeros((100, 200, 3), dtype=remap.numpy.uint8)
+        image[:50] = 255
+        face = remap.remap_face(image, 16, 0, -90)
+        self.assertEqual(face.shape, (16, 16, 4))
+        self.assertTrue((face[..., :3] == 255).all())
+        # a partial panorama leaves the rest of the face transparent
+        face = remap.remap_face(image, 16, 0, 0, hfov=90)
+        self.assertEqual(face[8, 8, 3], 255)
+        self.assertEqual(face[0, 0, 3], 0)
+
+    def test_cylinder_coordinates(self):
+        # the same width keeps the columns, the middle rows are the horizon
+        x, y = remap.cylinder_coordinates(400, 100, 400, 200)
+        self.assertTrue(abs(x[0] - remap.numpy.arange(400)).max() < 1e-3)
+        self.assertAlmostEqual(float(y[49:51].mean()), 99.5, places=3)
+        self.assertTrue(y[0, 0] > 0 and y[-1, 0] < 199)
+
+    def test_eq2cyl(self):
+        import PIL.Image
+        from fourpi.pannellum import eq2cyl
+        with tempfile.TemporaryDirectory() as folder:
+            panorama = os.path.join(folder, 'pano.jpg')
+            PIL.Image.new('RGB', (400, 200), 'red').save(panorama)
+            results = list(eq2cyl.convert_all([panorama, 'missing.jpg'], remapper='numpy', output_dir=folder))
+            self.assertEqual([error is None for panorama, out_name, error, seconds in results], [True, False])
+            with PIL.Image.open(results[0][1]) as cylinder:
+                self.assertEqual(cylinder.size, eq2cyl.cylinder_size(400))
+
+    def test_lookup_tables(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            tables = remap.LookupTables(tmp)
+            x1, y1 = tables.get(8, 90, 0, 400, 200)
+            x2, y2 = tables.get(8, 90, 0, 400, 200)
+            self.assertEqual((tables.hits, tables.misses), (1, 1))
+            self.assertTrue((x1 == x2).all() and (y1 == y2).all())
+            tables.max_bytes = 0
+            tables.get(8, 0, 0, 400, 200)
+            self.assertEqual(len(os.listdir(tmp)), 1)
+        finally:
+            shutil.rmtree(tmp)
+
+
+class FakeScene:
+
+    def __init__(self, scene_id, width):
+        self.scene_id = scene_id
+        self.width = width
+        self.height = width // 2
+        self.cubeResolution = int(width / 3.14)
+        self.tileResolution = 512
+        self.workers = 1
+        self.low_memory = False
+        self.remapper = 'numpy'
+        self.keep_faces = False
+
+
+class TestScheduler(unittest.TestCase):
+
+    def test_run(self):
+        def job(scene, force=False):
+            if scene.scene_id == 'broken':
+                raise ValueError('broken panorama')
+
+        scenes = [FakeScene('a', 2000), FakeScene('broken', 2000), FakeScene('huge', 20000)]
+        summary = Scheduler(scenes, jobs=2, memory_budget=2 ** 20, job=job).run()
+        self.assertEqual(sorted(summary['done']), ['a', 'huge'])
+        self.assertIn('broken panorama', summary['failed']['broken'])
+        self.assertEqual(len(summary['seconds']), 3)
+
+
+class TestSpatialIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.exifdata = dict(('s%d' % i, {'width': 2000, 'height': 1000,
+                                          'latlng': (51 + (i * 7919 % 101) / 1000.0, 6.7 + (i * 104729 % 97) / 1000.0)})
+                             for i in range(200))
+        self.exifdata['nogps'] = {'width': 2000, 'height': 1000}
+
+    def brute_force(self, scene_id, k=None, radius=None):
+        latlng = self.exifdata[scene_id]['latlng']
+        distances = sorted((haversine(latlng, exif['latlng']), other) for other, exif in self.exifdata.items()
+                           if other != scene_id and 'latlng' in exif)
+        distances = [(d, other) for d, other in distances if radius is None or d <= radius]
+        return [other for d, other in distances[:k]]
+
+    def test_nearest(self):
+        index = SpatialIndex(self.exifdata)
+        self.assertEqual(index.size, 200)
+        for scene_id in ('s0', 's17', 's199'):
+            latlng = self.exifdata[scene_id]['latlng']
+            nearest = index.nearest(latlng, k=5, exclude=scene_id)
+            self.assertEqual([s for d, s in nearest], self.brute_force(scene_id, k=5))
+            nearest = index.nearest(latlng, radius=1.5, exclude=scene_id)
+            self.assertEqual([s for d, s in nearest], self.brute_force(scene_id, radius=1.5))
+
+    def test_scene_hotspots(self):
+        scene = Scene('s1.jpg', exifdata=self.exifdata, max_hotspots=3)
+        self.assertEqual([hs['sceneId'] for hs in scene.conf['hotSpots']], self.brute_force('s1', k=3))
+        scene = Scene('nogps.jpg', exifdata=self.exifdata, max_hotspots=3)
+        self.assertEqual(len(scene.conf['hotSpots']), 200)
+
+
+@unittest.skipUnless(utils.numpy, "numpy not installed")
+class TestGeodesy(unittest.TestCase):
+
+    points = [(45.7597, 4.8422), (48.8567, 2.3508), (51.2277, 6.7735)]
+
+    def test_matrices(self):
+        distances = utils.haversine_matrix(self.points)
+        bearings = utils.bearing_matrix(self.points)
+        for i, p1 in enumerate(self.points):
+            for j, p2 in enumerate(self.points):
+                self.assertAlmostEqual(distances[i, j], haversine(p1, p2), places=6)
+                if i != j:
+                    self.assertAlmostEqual(bearings[i, j], utils.bearing(p1, p2), places=6)
+
+    def test_get_confs(self):
+        exifdata = {'a': {'title': 'A', 'latlng': self.points[0], 'northOffset': 10},
+                    'b': {'title': 'B', 'latlng': self.points[1], 'northOffset': 350},
+                    'c': {'title': 'C'}}
+        neighbours = {'a': ['b', 'c'], 'c': ['a']}
+        confs = hotspot.get_confs(exifdata, neighbours)
+        for src in neighbours:
+            for conf, dest in zip(confs[src], neighbours[src]):
+                expected = HotSpot(dest, exifdata[src], exifdata[dest]).get_conf()
+                self.assertEqual(conf['text'], expected['text'])
+                self.assertAlmostEqual(conf['yaw'], expected['yaw'], places=6)
+                self.assertAlmostEqual(conf['targetYaw'], expected['targetYaw'], places=6)
+
+
+class TestTuner(unittest.TestCase):
+
+    def test_candidates(self):
+        from fourpi.pannellum import tuner
+        for width in (2000, 8000, 25000):
+            for cube, tile, max_level in tuner.candidates(width):
+                self.assertEqual(cube % 2 ** (max_level - 1), 0)
+                self.assertLessEqual(cube // 2 ** (max_level - 1), tile)
+                if max_level > 1:
+                    self.assertGreater(cube // 2 ** (max_level - 2), tile)
+                self.assertGreaterEqual(cube, width / 3.1416 * (1 - tuner.MAX_RESOLUTION_LOSS))
+
+    def test_tune(self):
+        from fourpi.pannellum import tuner
+        exifdata = {'pano': {'width': 12000, 'height': 6000}}
+        default = Scene('pano.jpg', exifdata=exifdata)
+        tuned = Scene('pano.jpg', exifdata=exifdata, tune=True)
+        report = tuned.tuning
+        self.assertEqual(report['default']['cubeResolution'], default.cubeResolution)
+        self.assertEqual((tuned.cubeResolution, tuned.tileResolution, tuned.maxLevel),
+                         (report['chosen']['cubeResolution'], report['chosen']['tileResolution'],
+                          report['chosen']['maxLevel']))
+        self.assertLessEqual(report['chosen']['score'], report['default']['score'])
+        self.assertIn('instead of', report['reason'])
+        self.assertIn('(default)', tuner.format_report(report, top=len(report['candidates'])))
+        self.assertEqual(tuned.conf['multiRes']['tileResolution'], tuned.tileResolution)
+        self.assertIsNone(Scene('pano.jpg', exifdata=exifdata, tune=True, tile_size=512).tuning)
+
+
+@unittest.skipUnless(remap.numpy, "numpy not installed")
+class TestSceneTile(unittest.TestCase):
+
+    def setUp(self):
+        import PIL.Image
+        self.tmp = tempfile.mkdtemp()
+        self.pano = os.path.join(self.tmp, 'synthetic.jpg')
+        PIL.Image.new('RGB', (400, 200), (200, 100, 50)).save(self.pano)
+        self.exifdata = {'synthetic': {'width': 400, 'height': 200}}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def scene(self, folder='tiles', **kwargs):
+        kwargs.setdefault('tile_size', 64)
+        return Scene(self.pano, exifdata=self.exifdata, remapper='numpy',
+                     tile_folder=os.path.join(self.tmp, folder), **kwargs)
+
+    def test_manifest(self):
+        scene = self.scene()
+        scene.tile()
+        manifest = scene.read_manifest()
+        self.assertEqual(sorted(manifest['faces']), sorted(FACES))
+        tile = os.path.join(scene.tile_folder, '1', 'f0_0.jpg')
+        self.assertTrue(os.path.isfile(tile))
+
+        # up to date, nothing is rebuilt
+        os.remove(tile)
+        self.scene().tile()
+        self.assertFalse(os.path.isfile(tile))
+
+        # a different quality makes all tiles stale
+        self.scene(image_quality=0.5).tile()
+        self.assertTrue(os.path.isfile(tile))
+        self.assertEqual(self.scene(image_quality=0.5).read_manifest()['params']['quality'], 50)
+
+    def test_keep_faces(self):
+        faces = os.path.join(self.tmp, 'synthetic')
+        self.scene().tile()
+        self.assertFalse(os.path.exists(faces))
+        kept = self.scene('kept', keep_faces=True)
+        kept.tile()
+        self.assertEqual(len(os.listdir(faces)), 6)
+        for name in os.listdir(os.path.join(kept.tile_folder, '1')):
+            with open(os.path.join(kept.tile_folder, '1', name), 'rb') as f:
+                with open(os.path.join(self.tmp, 'tiles', 'synthetic', '1', name), 'rb') as g:
+                    self.assertEqual(f.read(), g.read())
+
+    def test_low_memory(self):
+        import PIL.Image
+        image = PIL.Image.effect_mandelbrot((400, 200), (-2, -1, 1, 1), 50).convert('RGB')
+        image.save(self.pano)
+        scene = self.scene(tile_size=32)
+        scene.tile()
+        low = self.scene('low', tile_size=32, low_memory=True)
+        low.tile()
+        for level in ('1', '2'):
+            for name in os.listdir(os.path.join(scene.tile_folder, level)):
+                tile = PIL.Image.open(os.path.join(scene.tile_folder, level, name))
+                strip_tile = PIL.Image.open(os.path.join(low.tile_folder, level, name))
+                self.assertEqual(list(tile.getdata()), list(strip_tile.getdata()))
+        fallback = PIL.Image.open(os.path.join(scene.tile_folder, 'fallback', 'f.jpg'))
+        strip_fallback = PIL.Image.open(os.path.join(low.tile_folder, 'fallback', 'f.jpg'))
+        self.assertEqual(list(fallback.getdata()), list(strip_fallback.getdata()))
+
+    def test_nona_fails(self):
+        nona = os.path.join(self.tmp, 'bin', 'nona')
+        os.makedirs(os.path.dirname(nona))
+        with open(nona, 'w') as f:
+            f.write('#!/bin/sh\necho broken >&2\nexit 1\n')
+        os.chmod(nona, 0o755)
+        path = os.environ['PATH']
+        os.environ['PATH'] = os.path.dirname(nona) + os.pathsep + path
+        utils.find_tool.cache_clear()
+        try:
+            scene = Scene(self.pano, exifdata=self.exifdata, remapper='nona', tile_size=64,
+                          tile_folder=os.path.join(self.tmp, 'tiles'))
+            summary = Scheduler([scene]).run()
+        finally:
+            os.environ['PATH'] = path
+            utils.find_tool.cache_clear()
+        self.assertIn('nona failed', summary['failed']['synthetic'])
+        # not taken for blank faces and up to date
+        self.assertEqual(scene.read_manifest().get('faces', []), [])
+
+    def test_parallel(self):
+        import PIL.Image
+        image = PIL.Image.effect_mandelbrot((400, 200), (-2, -1, 1, 1), 50).convert('RGB')
+        image.save(self.pano)
+        serial = self.scene('serial', tile_size=32)
+        serial.tile()
+        parallel = self.scene('parallel', tile_size=32, workers=3, threads=4)
+        parallel.tile()
+
+        def tree(folder):
+            files = {}
+            for root, dirs, names in os.walk(folder):
+                for name in names:
+                    if name != 'manifest.json':
+                        with open(os.path.join(root, name), 'rb') as f:
+                            files[os.path.relpath(os.path.join(root, name), folder)] = f.read()
+            return files
+
+        serial_tiles = tree(serial.tile_folder)
+        # 16 and 4 tiles of the two levels and the fallback image of each face
+        self.assertEqual(len(serial_tiles), 6 * (16 + 4 + 1))
+        self.assertEqual(tree(parallel.tile_folder), serial_tiles)
+
+    def test_shared_lookup_tables(self):
+        import threading
+        other = os.path.join(self.tmp, 'other.jpg')
+        shutil.copy(self.pano, other)
+        self.exifdata['other'] = dict(self.exifdata['synthetic'])
+        tables = remap.LookupTables(os.path.join(self.tmp, 'lut'))
+        scenes = [self.scene(lookup_tables=tables), Scene(other, exifdata=self.exifdata, remapper='numpy',
+                                                          tile_folder=os.path.join(self.tmp, 'tiles'),
+                                                          tile_size=64, lookup_tables=tables)]
+        together = threading.Barrier(2)
+
+        def job(scene, force=False):
+            # both scenes ask for the same tables at once
+            together.wait(10)
+            scene.tile(force=force)
+
+        summary = Scheduler(scenes, jobs=2, memory_budget=2 ** 40, job=job).run()
+        self.assertEqual(summary['failed'], {})
+        self.assertEqual(sorted(summary['done']), ['other', 'synthetic'])
+        self.assertEqual(tables.misses, 6)
+
+    def test_fallback(self):
+        scene = self.scene()
+        scene.tile()
+        fallback = os.path.join(scene.tile_folder, 'fallback', 'u.jpg')
+        self.assertTrue(os.path.isfile(fallback))
+        os.utime(fallback, (0, 0))
+        # made by tile() just now, not scaled down again
+        scene.fallback(force=True)
+        self.assertEqual(os.path.getmtime(fallback), 0)
+        os.remove(fallback)
+        self.scene().fallback()
+        self.assertTrue(os.path.isfile(fallback))
+
+    def test_tile_format(self):
+        import PIL.Image
+        scene = self.scene(tile_format='webp', image_quality=0.7)
+        self.assertEqual(scene.conf['multiRes']['extension'], 'webp')
+        scene.tile()
+        self.assertEqual(PIL.Image.open(os.path.join(scene.tile_folder, '1', 'f0_0.webp')).format, 'WEBP')
+        self.assertEqual(PIL.Image.open(os.path.join(scene.tile_folder, 'fallback', 'f.webp')).format, 'WEBP')
+        png = self.scene('png', tile_format='png', resize_filter='nearest', low_memory=True)
+        png.tile()
+        self.assertEqual(PIL.Image.open(os.path.join(png.tile_folder, '1', 'f0_0.png')).format, 'PNG')
+        self.assertRaises(ValueError, self.scene, tile_format='gif')
+
+    def test_dedup(self):
+        # a cropped panorama, the top and bottom faces are blank
+        self.exifdata['synthetic'].update({'panoHeight': 400, 'croppedHeight': 200, 'croppedTop': 100})
+        scene = self.scene(tile_size=32, dedup='hardlink')
+        scene.tile()
+        stats = scene.read_manifest()['dedup']
+        self.assertEqual(stats['tiles'], stats['unique'] + stats['linked'])
+        self.assertTrue(stats['linked'] > 0 and stats['bytes_saved'] > 0)
+        up = os.stat(os.path.join(scene.tile_folder, '1', 'u1_1.jpg'))
+        down = os.stat(os.path.join(scene.tile_folder, '1', 'd1_1.jpg'))
+        self.assertEqual(up.st_ino, down.st_ino)
+
+        # made again, counted once and linked to the new files only
+        scene.tile(force=True)
+        self.assertEqual(scene.read_manifest()['dedup'], stats)
+        self.assertEqual(os.stat(os.path.join(scene.tile_folder, '1', 'u1_1.jpg')).st_nlink, up.st_nlink)
+
+        # tiled by several processes, linked afterwards
+        parallel = self.scene('parallel', tile_size=32, dedup='symlink', workers=2)
+        parallel.tile()
+        linked = parallel.read_manifest()['dedup']
+        for key in ('tiles', 'unique', 'linked', 'bytes_saved'):
+            self.assertEqual(linked[key], stats[key])
+        self.assertTrue(os.path.islink(os.path.join(parallel.tile_folder, '1', 'd1_1.jpg')))
+
+    def test_archive(self):
+        import threading
+        import urllib.request
+        from fourpi.pannellum.archive import server, ARCHIVE
+        scene = self.scene(archive=True, workers=2)
+        scene.tile()
+        scene.fallback()
+        self.assertEqual(sorted(os.listdir(scene.tile_folder)), ['manifest.json', ARCHIVE])
+        self.assertTrue(scene.encoder.exists(os.path.join(scene.tile_folder, 'fallback', 'u.jpg')))
+        data, digest = scene.encoder.archive.get('1/f0_0.jpg')
+
+        httpd = server(os.path.join(self.tmp, 'tiles'), port=0)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        try:
+            url = 'http://127.0.0.1:%s/synthetic/1/f0_0.jpg' % httpd.server_address[1]
+            with urllib.request.urlopen(url) as response:
+                self.assertEqual(response.headers['Content-Type'], 'image/jpeg')
+                self.assertEqual(response.read(), data)
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+
+    def test_lazy(self):
+        import PIL.Image
+        from fourpi.pannellum.lazy import LazyTiles
+        image = PIL.Image.effect_mandelbrot((400, 200), (-2, -1, 1, 1), 50).convert('RGB')
+        image.save(self.pano)
+        scene = self.scene(tile_size=32)
+        scene.tile()
+        tiles = LazyTiles([self.scene('lazy', tile_size=32)], disk_cache=True)
+        with open(os.path.join(scene.tile_folder, '2', 'r1_2.jpg'), 'rb') as f:
+            self.assertEqual(tiles.get('synthetic', '2/r1_2.jpg'), f.read())
+        # the rest of the row is cached
+        self.assertIsNotNone(tiles.get('synthetic', '2/r1_0.jpg'))
+        self.assertEqual(tiles.cache.hits, 1)
+        self.assertTrue(os.path.isfile(os.path.join(self.tmp, 'lazy', 'synthetic', '2', 'r1_3.jpg')))
+        lower = tiles.get('synthetic', '1/r0_0.jpg')
+        self.assertEqual(PIL.Image.open(io.BytesIO(lower)).size, (32, 32))
+        self.assertIsNotNone(tiles.get('synthetic', 'fallback/u.jpg'))
+        for name in ('3/f0_0.jpg', '2/f9_0.jpg', '2/f0_0.png', '../synthetic.jpg', 'fallback/x.jpg'):
+            self.assertIsNone(tiles.get('synthetic', name))
+
+    def test_metrics(self):
+        from fourpi.pannellum.metrics import metrics
+        metrics.reset()
+        scene = self.scene(workers=2)
+        scene.tile()
+        report = metrics.report()
+        # 4 tiles and the fallback of each face, encoded in worker processes
+        self.assertEqual(report['counters']['tiles'], 24)
+        self.assertEqual(report['counters']['fallbacks'], 6)
+        self.assertEqual(report['stages']['encode']['calls'], 30)
+        self.assertEqual(report['stages']['tile']['calls'], 1)
+        self.assertEqual(report['stages']['extract.remap']['calls'], 6)
+        self.assertIn('pannellum_tiles_total 24\n', metrics.prometheus())
+
+        def stored(folder):
+            inodes = {}
+            for root, dirs, files in os.walk(folder):
+                for name in files:
+                    if name != 'manifest.json':
+                        stat = os.stat(os.path.join(root, name))
+                        inodes[stat.st_ino] = stat.st_size
+            return sum(inodes.values())
+
+        self.assertEqual(report['counters']['bytes_written'], stored(scene.tile_folder))
+        # the linked duplicates take no space
+        metrics.reset()
+        deduplicated = self.scene('dedup', dedup='hardlink', workers=2)
+        deduplicated.tile()
+        report = metrics.report()
+        self.assertEqual(report['counters']['bytes_written'], stored(deduplicated.tile_folder))
+        self.assertLess(report['counters']['bytes_written'], report['counters']['encoded_bytes'])
+
+        # forked while another thread holds the lock
+        import multiprocessing
+        with metrics._lock:
+            child = multiprocessing.get_context('fork').Process(target=metrics.reset)
+            child.start()
+            child.join(10)
+        if child.is_alive():
+            child.kill()
+        self.assertEqual(child.exitcode, 0)
+
+
+class TestTourJson(unittest.TestCase):
+
+    def setUp(self):
+        from fourpi.pannellum import benchmark
+        self.exifdata = benchmark.synthetic_tour(5)
+        self.panoramas = ['%s.jpg' % scene_id for scene_id in self.exifdata]
+
+    def test_stream(self):
+        for debug in (False, True):
+            tour = Tour(self.exifdata, self.panoramas, debug=debug)
+            expected = json.dumps(tour.conf, sort_keys=debug, indent=4 if debug else None,
+                                  separators=(', ', ': ') if debug else (',', ':'))
+            self.assertEqual(tour.get_json(), expected)
+
+    def test_split(self):
+        tour = Tour(self.exifdata, self.panoramas)
+        with tempfile.TemporaryDirectory() as folder:
+            tour.write_split(folder)
+            with open(os.path.join(folder, 'index.json')) as f:
+                index = json.load(f)
+            self.assertEqual(index['default'], tour.default)
+            self.assertEqual(index['scenes']['scene0002'], {'title': 'Scene 2', 'config': 'scenes/scene0002.json'})
+            with open(os.path.join(folder, 'scenes', 'scene0002.json')) as f:
+                self.assertEqual(json.load(f), json.loads(tour.get_json())['scenes']['scene0002'])
+
+    def test_flat_memory(self):
+        import tracemalloc
+        from fourpi.pannellum import benchmark
+
+        class Sink:
+            def write(self, text):
+                pass
+
+        def traced(scenes, **kwargs):
+            exifdata = benchmark.synthetic_tour(scenes)
+            tour = Tour(exifdata, ['%s.jpg' % scene_id for scene_id in exifdata], **kwargs)
+            tracemalloc.start()
+            try:
+                tour.write_json(Sink())
+                return tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+
+        traced(10)
+        # no configuration is held once written, every scene links to the 299 others
+        held, peak = traced(300)
+        self.assertLess(held, 2 ** 20)
+        # nor while writing, with a few links per scene
+        held, peak = traced(600, max_hotspots=5)
+        self.assertLess(held, 2 ** 18)
+        self.assertLess(peak, 2 ** 20)
+
+    def test_conf_cache(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'conf.sqlite')
+            cache = ConfCache(path)
+            expected = Tour(self.exifdata, self.panoramas, conf_cache=cache).get_json()
+            cache.close()
+            self.exifdata['scene0003']['pan'] = 90
+            cache = ConfCache(path)
+            tour = Tour(self.exifdata, self.panoramas, conf_cache=cache)
+            self.assertNotEqual(tour.get_json(), expected)
+            self.assertEqual((cache.hits, cache.misses), (4, 1))
+            self.assertEqual(tour.conf['scenes']['scene0003']['yaw'], 90)
+            cache.close()
+            # every scene links to the renamed one
+            self.exifdata['scene0004']['title'] = 'Renamed'
+            cache = ConfCache(path)
+            Tour(self.exifdata, self.panoramas, conf_cache=cache).get_json()
+            self.assertEqual((cache.hits, cache.misses), (0, 5))
+            cache.close()
+
+    def test_lazy_conf(self):
+        scene = Scene('scene0001.jpg', exifdata=self.exifdata)
+        self.assertIsNone(scene._conf)
+        self.assertEqual(scene.conf['title'], 'Scene 1')
+        self.exifdata['scene0001']['title'] = 'Renamed'
+        self.assertEqual(scene.conf['title'], 'Renamed')
+        # and once a scene it links to changed
+        scene = Scene('scene0000.jpg', exifdata=self.exifdata)
+        self.assertIn('Renamed', json.dumps(scene.conf['hotSpots']))
+        self.exifdata['scene0001']['title'] = 'Scene 1'
+        self.assertNotIn('Renamed', json.dumps(scene.conf['hotSpots']))
+
+    def test_neighbour_renamed(self):
+        tour = Tour(self.exifdata, self.panoramas)
+        self.assertIn('Scene 1', json.loads(tour.get_json())['scenes']['scene0000']['hotSpots'][0]['text'])
+        self.exifdata['scene0001']['title'] = 'Renamed'
+        texts = [hs['text'] for hs in json.loads(tour.get_json())['scenes']['scene0000']['hotSpots']]
+        self.assertIn('Renamed', ' '.join(texts))
+        self.assertNotIn('Scene 1', ' '.join(texts))
+        # kept by the scene after the tour linked the scenes again
+        conf = tour.scenes[0].conf
+        self.exifdata['scene0001']['title'] = 'Again'
+        tour._link_scenes()
+        self.assertIsNot(tour.scenes[0].conf, conf)
+        self.assertIn('Again', json.dumps(tour.scenes[0].conf['hotSpots']))
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_cropped_panorama(self):
+        from fourpi.pannellum import benchmark
+        width, height, pano_height = benchmark.PANORAMAS['cropped']
+        with tempfile.TemporaryDirectory() as folder:
+            path = benchmark.synthetic_panorama(os.path.join(folder, 'cropped.jpg'), width, height, pano_height)
+            exifdata = Exif([path], backend='python').get_exifdata()
+        expected = benchmark.synthetic_exifdata('cropped', width, height, pano_height)
+        for key in ('width', 'height', 'panoHeight', 'croppedHeight', 'croppedTop'):
+            self.assertEqual(exifdata['cropped'][key], expected[key])
+
+    def test_tour(self):
+        from fourpi.pannellum import benchmark
+        report = benchmark.Benchmark(None, repeat=1, panoramas=(), tour_scenes=10).run()
+        self.assertEqual(sorted(report['results']), ['startup/eq2cyl', 'startup/exif2rst', 'startup/pannellum',
+                                                     'tour/hotspots', 'tour/json', 'tour/scenes'])
+        baseline = {'results': {'tour/json': {'seconds': report['results']['tour/json']['seconds'] / 2}}}
+        self.assertEqual([name for name, seconds, before in benchmark.regressions(report, baseline)], ['tour/json'])
+        self.assertEqual(benchmark.regressions(report, baseline, threshold=10), [])
+        self.assertEqual([name for name, seconds in benchmark.over_budget(report, 0)],
+                         ['startup/eq2cyl', 'startup/exif2rst', 'startup/pannellum'])
+
+    def test_startup_imports(self):
+        # the console scripts start without the heavy or rarely needed modules
+        from fourpi.pannellum import benchmark
+        code = "import sys, %s; print(' '.join(m for m in ('numpy', 'distutils', 'http.server') if m in sys.modules))"
+        for module in benchmark.ENTRY_POINTS.values():
+            result = subprocess.run([sys.executable, '-c', code % module], capture_output=True, text=True, check=True)
+            self.assertEqual(result.stdout.strip(), '', module)
+        # nor with Pillow, needed once images are read or written
+        code = "import sys, fourpi.pannellum.%s; print('PIL' in sys.modules)"
+        for module in ('tour', 'eq2cyl'):
+            result = subprocess.run([sys.executable, '-c', code % module], capture_output=True, text=True, check=True)
+            self.assertEqual(result.stdout.strip(), 'False', module)
+
+
 if __name__ == '__main__':
     unittest.main()